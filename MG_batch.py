@@ -0,0 +1,58 @@
+# precomputes snippets offline and writes them as a SongCatalogue, i.e.
+#   python MG_batch.py --playlists spotify:playlist:37i9dQZF1DXcBWIGoYBM5M --out CATALOGUE
+#   python MG_batch.py --pages saved_watch_pages/ --out CATALOGUE
+# with --catalogue the songs are also added to the SnippetCatalogue the MedleyGenerator starts medleys from
+#   python MG_batch.py --playlists spotify:playlist:37i9dQZF1DXcBWIGoYBM5M --catalogue SNIPPET_CATALOGUE.sqlite
+
+def parse_args():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description = 'Precompute medley snippets for whole catalogues.')
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument('--playlists', nargs = '+', metavar = 'URI', help = 'spotify playlist uris')
+    source.add_argument('--pages', metavar = 'DIR', help = 'directory of saved youtube watch pages named <video id>.html')
+    parser.add_argument('--out', help = 'directory to write the SongCatalogue to')
+    parser.add_argument('--catalogue', help = 'SnippetCatalogue (sqlite file) to add the songs to')
+    parser.add_argument('--snippet', type = int, default = 15, help = 'snippet duration in seconds')
+    parser.add_argument('--processes', type = int, default = None, help = 'worker processes; default one per core')
+    parser.add_argument('--concurrency', type = int, default = 8, help = 'tracks fetched at once')
+    parser.add_argument('--env', default = '.env_spotify', help = 'file with the spotify credentials')
+    args = parser.parse_args()
+    if not (args.out or args.catalogue):
+        parser.error('one of the arguments --out --catalogue is required')
+    if args.catalogue and args.pages:
+        parser.error('--catalogue needs spotify uris and thus --playlists')
+    return args
+
+async def main(args):
+    import os
+    from src.SnippetBatch import SnippetBatch
+
+    with SnippetBatch(
+                window_size_in_sec = args.snippet,
+                no_of_processes = args.processes,
+                max_concurrency = args.concurrency) as batch:
+
+        if args.pages:
+            songs = await batch.run_pages(args.pages)
+        else:
+            from src.AsyncHandler import AsyncHandler
+            from src.SpotifyHandler import SpotifyHandler
+            from src.AsyncYTHandler import AsyncYTHandler
+
+            ash = AsyncHandler()
+            sp_handler = SpotifyHandler(ash, os.path.join(os.getcwd(), args.env))
+            yt_handler = AsyncYTHandler(_async_handler = ash)
+            await yt_handler.setup()
+
+            songs = await batch.run_playlists(args.playlists, sp_handler, yt_handler)
+
+        if args.out:
+            batch.save(args.out, songs)
+        if args.catalogue:
+            from src.SnippetCatalogue import SnippetCatalogue
+            SnippetCatalogue(args.catalogue).put_many(songs)
+
+if __name__ == "__main__":
+    from asyncio import run as asyncio_run
+    asyncio_run(main(parse_args()))
@@ -57,15 +57,19 @@ async def play():
     play_func = mg.sp_play()
     pl_uri = st.session_state.mg_pl_uri[st.session_state.sp_pl_selected]
     
-    # MedleyContextManager
-    async with mg.create_medley(pl_uri, snippet_length) as status_and_generator:
-        await mg.gather_songs(pl_uri, snippet_length, mg.ash.get_queue('songs')) # making songs available
+    # MedleyContextManager; songs are resolved in the background, keeping the next 3 ready
+    # once every song has played, the playlist goes on with the 2nd and 3rd best moments
+    async with mg.create_medley(pl_uri, snippet_length, look_ahead = 3, highlights = 3) as status_and_generator:
         status = status_and_generator[0]
         mg_play = status_and_generator[1]()
             
-        for play_uri, play_offset_in_ms in mg_play:
-            play_func(play_uri, position_ms = play_offset_in_ms)
+        async for play_uri, play_offset_in_ms in mg_play:
+            await play_func(play_uri, position_ms = play_offset_in_ms)
             await mg.ash.sleep(snippet_length)
+            
+            # a new snippet length applies from the next song on; the starts are looked up
+            snippet_length = st.session_state.play_duration_in_sec
+            status['snippet_duration_in_sec'] = snippet_length
     mg.toggle_play()
             
 def display_player():    
@@ -0,0 +1,115 @@
+from src.RequestsYTHandler import RequestsYTHandler, HeatMarkerScanner
+
+class AsyncYTHandler(RequestsYTHandler):
+    '''
+    Non-blocking variant of RequestsYTHandler. All shards share one pooled aiohttp connector;
+    their proxy is passed per request, so the connector keeps alive and reuses connections for
+    every proxy separately and several get_most_replayed calls overlap on one event loop.
+    '''
+    from src.utils import PrintLogger
+
+    def __init__(
+                    self,
+                    dump_info = PrintLogger.register('AsyncYTHandler'),
+                    connection_limit = 20,
+                    keepalive_timeout_in_sec = 30,
+                    *args, **kwargs):
+        self.connector = None
+        self.connection_limit = connection_limit
+        self.keepalive_timeout_in_sec = keepalive_timeout_in_sec
+
+        super().__init__(dump_info = dump_info, *args, **kwargs)
+
+    def quit_connection(self):
+        super().quit_connection()
+        if self.connector and not self.connector.closed:
+            self.run_soon(self.connector.close())
+        self.connector = None
+
+    def run_soon(self, closing):
+        # aiohttp closes asynchronously
+        from inspect import isawaitable
+        from asyncio import ensure_future as asyncio_ensure_future
+
+        if isawaitable(closing):
+            asyncio_ensure_future(closing)
+
+    def create_session(self):
+        from src.utils import install_pip_pkg
+        install_pip_pkg({'aiohttp'})
+        import aiohttp
+
+        if (not self.connector) or self.connector.closed:
+            self.connector = aiohttp.TCPConnector(
+                                limit = self.connection_limit,
+                                keepalive_timeout = self.keepalive_timeout_in_sec)
+
+        # no total timeout: the body is streamed and only read as far as needed
+        timeout = aiohttp.ClientTimeout(total = None, connect = 10, sock_read = 10)
+
+        # sessions only hold cookies; pooled connections stay with the shared connector
+        return aiohttp.ClientSession(connector = self.connector, connector_owner = False, timeout = timeout)
+
+    def close_session(self, session):
+        if not session.closed:
+            self.run_soon(session.close())
+
+    async def get(self, url, read = None):
+        import aiohttp
+        from time import monotonic
+        from asyncio import TimeoutError as asyncio_TimeoutError
+        from src.RetryHandler import RetryableError
+
+        async def attempt():
+            shard = self.pick_shard()
+            try:
+                # released in finally even if cancelled while waiting for the slot
+                await shard.acquire()
+                started = monotonic()
+                response = await shard.session.get(url, proxy = shard.proxy, headers = shard.headers)
+            except aiohttp.ClientProxyConnectionError as pe:
+                self.report_proxy_failure(proxy_address = shard.proxy_address)
+                self.dump_info().log('Changing proxy.')
+                await self.rotate_shard(shard)
+                raise RetryableError('Proxy Error.')
+            except (aiohttp.ClientError, asyncio_TimeoutError) as ce:
+                self.report_proxy_failure(proxy_address = shard.proxy_address)
+                raise RetryableError('Connection Error.')
+            finally:
+                shard.release()
+
+            if str(response.url) != url:     # redirected to captcha
+                self.dump_info().log('Ran into captcha police. New proxy and user agent.')
+                self.report_proxy_failure(is_captcha = True, proxy_address = shard.proxy_address)
+                response.close()
+                await self.rotate_shard(shard)
+                raise RetryableError('Captcha.')
+
+            if read:
+                try:
+                    response = await read(response)
+                except (aiohttp.ClientError, asyncio_TimeoutError) as ce:
+                    self.report_proxy_failure(proxy_address = shard.proxy_address)
+                    raise RetryableError('Connection Error while reading.')
+
+            self.report_proxy_success(monotonic() - started, proxy_address = shard.proxy_address)
+            return response
+
+        return await self.retry_handler.run(attempt, url)
+
+    async def get_heat_markers(self, response, chunk_size = 16 * 1024):
+        scanner = HeatMarkerScanner()
+        is_done = False
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                is_done = scanner.feed(chunk)
+                if is_done:
+                    break
+        finally:
+            if is_done:
+                # the rest of the page is not read, so this connection cannot be reused
+                response.close()
+            else:
+                response.release()
+
+        return scanner.get_heat_markers()
@@ -0,0 +1,157 @@
+class CacheHandler():
+    '''
+    Persistent key-value cache on top of a SQLite table. Values are pickled.
+    Entries older than ttl_in_sec are dropped on access and when the cache is opened; once there
+    are more than max_entries, the least recently used ones are evicted.
+    With memory_size > 0 the memory_size most recently used entries are additionally kept in
+    memory in front of the table; without cache_file_path the cache lives in memory only.
+    '''
+    from src.utils import PrintLogger
+
+    def __init__(
+                    self,
+                    cache_file_path,
+                    table = 'cache',
+                    ttl_in_sec = None,
+                    max_entries = None,
+                    memory_size = 0,
+                    dump_info = PrintLogger.register('CacheHandler')):
+        import sqlite3
+        from threading import Lock
+        from collections import OrderedDict
+
+        self.path = cache_file_path
+        self.table = table
+        self.ttl_in_sec = ttl_in_sec
+        self.max_entries = max_entries
+        self.memory_size = memory_size
+        self.dump_info = dump_info
+
+        # key -> (value, created); ordered from least to most recently used
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # handlers call the cache from worker threads as well
+        self.lock = Lock()
+        self.con = None
+        if not self.path:
+            return
+
+        self.con = sqlite3.connect(self.path, check_same_thread = False)
+        with self.lock, self.con:
+            self.con.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (
+                                    key TEXT PRIMARY KEY,
+                                    value BLOB NOT NULL,
+                                    created REAL NOT NULL,
+                                    accessed REAL NOT NULL)''')
+            self.con.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)')
+        self.remove_expired()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        if exc_type:
+            print(exc_type, exc_value, exc_traceback)
+
+    def close(self):
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    def is_expired(self, created, now):
+        return (self.ttl_in_sec is not None) and (created + self.ttl_in_sec <= now)
+
+    def remember(self, key, value, created):
+        if self.memory_size <= 0:
+            return
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last = False)
+
+    def get(self, key, default = None):
+        from time import time
+        from pickle import loads as pickle_loads
+
+        now = time()
+        with self.lock:
+            if key in self.memory:
+                value, created = self.memory[key]
+                if not self.is_expired(created, now):
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.memory[key]
+
+            if not self.con:
+                self.misses += 1
+                return default
+
+        with self.lock, self.con:
+            row = self.con.execute(f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if not row:
+                self.misses += 1
+                return default
+
+            value, created = row
+            if self.is_expired(created, now):
+                self.con.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                self.misses += 1
+                return default
+
+            self.con.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+            value = pickle_loads(value)
+            self.remember(key, value, created)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        from time import time
+        from pickle import dumps as pickle_dumps
+        from pickle import HIGHEST_PROTOCOL
+
+        now = time()
+        with self.lock:
+            self.remember(key, value, now)
+        if not self.con:
+            return
+
+        blob = pickle_dumps(value, protocol = HIGHEST_PROTOCOL)
+        with self.lock, self.con:
+            self.con.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)', (key, blob, now, now))
+            if self.max_entries:
+                # keep the max_entries most recently used
+                self.con.execute(f'''DELETE FROM {self.table} WHERE key IN (
+                                        SELECT key FROM {self.table}
+                                        ORDER BY accessed DESC
+                                        LIMIT -1 OFFSET ?)''', (self.max_entries,))
+
+    def delete(self, key):
+        with self.lock:
+            self.memory.pop(key, None)
+        if not self.con:
+            return
+
+        with self.lock, self.con:
+            self.con.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def remove_expired(self):
+        from time import time
+
+        if (self.ttl_in_sec is None) or (not self.con):
+            return
+        with self.lock, self.con:
+            removed = self.con.execute(
+                            f'DELETE FROM {self.table} WHERE created <= ?',
+                            (time() - self.ttl_in_sec,)).rowcount
+        if removed:
+            self.dump_info().log(f'Removed {removed} expired entries from {self.table}.')
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if not self.con:
+            return
+
+        with self.lock, self.con:
+            self.con.execute(f'DELETE FROM {self.table}')
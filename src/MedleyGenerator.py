@@ -2,7 +2,12 @@ class MedleyGenerator():
      
     from src.utils import PrintLogger
     
-    def __init__(self, player_name, _async_handler = None, _dump_info = PrintLogger.register('MedleyGenerator')):
+    def __init__(
+                self, 
+                player_name, 
+                _async_handler = None, 
+                catalogue_path = 'SNIPPET_CATALOGUE.sqlite', 
+                _dump_info = PrintLogger.register('MedleyGenerator')):
             
         self.run_asynch_manually = False
         self.song_dict = {}
@@ -12,6 +17,11 @@ class MedleyGenerator():
         self.sp_handler = None
         self.yt_handler = None
         
+        # precomputed snippets per spotify uri; None resolves every track live
+        self.catalogue_path = catalogue_path
+        self.catalogue = None
+        self.indexer = None
+        
         if not _async_handler:
             from src.streamlit_interface import AsyncHandler
             self.ash = AsyncHandler()
@@ -25,19 +35,37 @@ class MedleyGenerator():
     
     async def setup(self):
         self.run_asynch_manually = False
-        from src.streamlit_interface import SpotifyHandler, RequestsYTHandler
+        from src.streamlit_interface import SpotifyHandler, AsyncYTHandler
         import os
         
         with self.dump_info('Setting up Connection to Spotify'):
             self.sp_handler = SpotifyHandler(_async_handler = self.ash,
                                          env_file_path = os.path.join(os.getcwd(), '.env_spotify'), 
                                          playable = True)
+            self.sp_handler.start_token_refresh()
         
         with self.dump_info('Creating YoutubeHandler'):
-            self.yt_handler = RequestsYTHandler(_async_handler = self.ash)
+            self.yt_handler = AsyncYTHandler(_async_handler = self.ash)
         with self.dump_info('Setting up Connection to Youtube'):
             await self.yt_handler.setup()
         
+        if self.catalogue_path:
+            from src.streamlit_interface import SnippetCatalogue
+            self.catalogue = SnippetCatalogue(self.catalogue_path)
+        
+    def start_indexer(self, pl_uris = None, **kwargs):
+        # fills the catalogue from popular playlists in the background; needs a running event loop
+        from src.SnippetCatalogue import SnippetIndexer
+        
+        if self.catalogue is None:
+            self.dump_info().log(f'No catalogue to index into.', important = True)
+            return
+        if not self.indexer:
+            # the catalogue scores every window size itself, the one given here does not matter
+            resolve = lambda *track: self.resolve_song(*track, self.catalogue.window_sizes_in_sec[0])
+            self.indexer = SnippetIndexer(self.catalogue, self.sp_handler, resolve, pl_uris, **kwargs)
+        self.indexer.start()
+        
     def get_token(self):
         return self.sp_handler.get_token()
     
@@ -45,14 +73,12 @@ class MedleyGenerator():
         return self.sp_handler.search_playlist(query)
     
     def sp_play(self):
-        # lambda func as opposed to functools.partials use late bindings (keeping the reference
-        # to the scope of device_id but fetching it not until execution) which makes it perfect
-        # to avoid problems around changing device id
-    
-        with self.dump_info(f'Getting Spotify device_id for {self.player_name}'):
-            device_id = self.sp_handler.get_device_id(self.player_name, wait=True)
-        play_func = lambda x, **kwargs: self.sp_handler.play(
-                                                device_id, # device_id = 
+        # the device id is looked up on every call from the handler's device registry, which
+        # only asks spotify again once the device is gone (i.e. after reloading the embed)
+        
+        # returns a coroutine; playback runs on the handler's executor
+        play_func = lambda x, **kwargs: self.sp_handler.play_on_device_async(
+                                                self.player_name,
                                                 context_uri = None,
                                                 uris = [x], 
                                                 **kwargs)
@@ -64,109 +90,236 @@ class MedleyGenerator():
         return_code = self.sp_handler.toggle_play(device_id)
         return return_code
         
-    def create_medley(self, pl_uri, snippet_duration_in_sec):
+    def create_medley(
+                self, 
+                pl_uri, 
+                snippet_duration_in_sec, 
+                no_of_workers = 4, 
+                max_tracks = None, 
+                policy = 'playlist', 
+                look_ahead = None, 
+                highlights = 1):
+        # look_ahead = N resolves songs in the background while the medley plays, keeping the
+        # next N songs ready; playing starts as soon as the first song is resolved
+        # highlights = K plays the playlist up to K times, every round with the next best
+        # non-overlapping moment of each song; no further requests are needed for that
         import asyncio
         
         song_queue_name = 'songs'
         self.ash.add_queue(song_queue_name)
         
+        if look_ahead:
+            producer = lambda prefetch_slots: self.gather_songs(
+                                                    pl_uri, 
+                                                    snippet_duration_in_sec, 
+                                                    self.ash.get_queue(song_queue_name),
+                                                    no_of_workers,
+                                                    max_tracks,
+                                                    prefetch_slots)
+            return MedleyContextManager(
+                        self.ash.get_queue(song_queue_name), 
+                        policy = policy, 
+                        look_ahead = look_ahead, 
+                        producer = producer,
+                        snippet_duration_in_sec = snippet_duration_in_sec,
+                        highlights = highlights)
+        
         with self.dump_info('Gathering Songs'):
-            ran = self.ash.run(self.gather_songs, (
+            ran = self.ash.run(self.gather_songs, 
                                     pl_uri, 
                                     snippet_duration_in_sec, 
-                                    self.ash.get_queue(song_queue_name)))
+                                    self.ash.get_queue(song_queue_name),
+                                    no_of_workers,
+                                    max_tracks)
             
             self.run_asynch_manually = not ran
                 
-        return MedleyContextManager(self.ash.get_queue(song_queue_name))
+        return MedleyContextManager(
+                    self.ash.get_queue(song_queue_name), 
+                    policy = policy, 
+                    snippet_duration_in_sec = snippet_duration_in_sec,
+                    highlights = highlights)
                    
-    async def gather_songs(self, pl_uri, snippet_duration_in_sec, song_queue):
+    async def gather_songs(
+                self, 
+                pl_uri, 
+                snippet_duration_in_sec, 
+                song_queue, 
+                no_of_workers = 4, 
+                max_tracks = None, 
+                prefetch_slots = None):
+        # max_tracks = N only resolves the first N tracks of the playlist so that a medley
+        # can start as soon as these are ready
+        # tracks in the catalogue go straight into the song queue; only the others are resolved
+        # prefetch_slots: semaphore bounding resolved but not yet played songs; a worker takes a
+        # slot before resolving a track and the MedleyContextManager gives it back on playing
+        from asyncio import Queue as asyncio_Queue
+        from asyncio import create_task as asyncio_create_task
         
         self.run_asynch_manually = False
         
-        # get tracks for chosen playlist
-        with self.dump_info('Retrieving Songs from Spotify'):
-            sp_track_uri, sp_track_names, sp_track_artists, sp_track_duration, sp_track_popularity = \
-                self.sp_handler.get_playlist_tracks(pl_uri)
-
-        # search tracks on yt
-        for counter in range(len(sp_track_names)):
-            yt_vid_id, yt_vid_name = self.yt_handler.search(sp_track_names[counter])
-
-            # choose popular moments
+        track_queue = asyncio_Queue()
+        
+        # every worker resolves search -> heatmap -> snippet for one track at a time; songs are
+        # put into the song queue in the order they finish, not in playlist order
+        workers = [asyncio_create_task(self.song_worker(track_queue, song_queue, snippet_duration_in_sec, prefetch_slots))
+                   for _ in range(max(1, no_of_workers))]
+        
+        try:
+            # get tracks for chosen playlist; workers start on the first page while later ones load
+            with self.dump_info('Retrieving Songs from Spotify'):
+                async for offset, tracks in self.sp_handler.iter_playlist_pages(pl_uri, max_tracks = max_tracks):
+                    if max_tracks:
+                        tracks = tracks[:max_tracks - offset]
+                    
+                    hits = {}
+                    if self.catalogue is not None:
+                        hits = self.catalogue.get_many(tracks, snippet_duration_in_sec)
+                        self.dump_info().log(f'Found {len(hits)} of {len(tracks)} tracks in the catalogue.')
+                    for position, track in enumerate(tracks, offset):
+                        song = hits.get(track[0])
+                        if not song:
+                            track_queue.put_nowait((position, track))
+                            continue
+                        
+                        song.position = position
+                        if prefetch_slots:
+                            await prefetch_slots.acquire()
+                        await song_queue.put(song)
             
-            with self.dump_info(f'Grab Popularity from Youtube for "{yt_vid_name}"'):
-                popularity_graph = await self.yt_handler.get_most_replayed(yt_vid_id, sp_track_duration[counter])
-                snippet_start_in_ms = self.sliding_window(popularity_graph, snippet_duration_in_sec)
-
-            uri_as_key = sp_track_uri[counter]
-            await song_queue.put(Song(
-                                        uri_as_key,
-                                        sp_track_names[counter],
-                                        sp_track_artists[counter],
-                                        sp_track_duration[counter],
-                                        sp_track_popularity[counter],
-                                        yt_vid_id,
-                                        yt_vid_name,
-                                        popularity_graph,
-                                        snippet_start_in_ms)
-                                )
+            await track_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.ash.gather(*workers, return_exceptions = True)
+            
+    async def song_worker(self, track_queue, song_queue, snippet_duration_in_sec, prefetch_slots = None):
+        from asyncio import sleep as asyncio_sleep
+        from asyncio import to_thread as asyncio_to_thread
+        from src.RetryHandler import CircuitOpenError
+        
+        while True:
+            # a slot is only taken with a track at hand: idle workers holding slots would starve
+            # catalogue hits waiting for one in gather_songs
+            position, track = await track_queue.get()
+            song = None
+            has_slot = False
+            try:
+                if prefetch_slots:
+                    await prefetch_slots.acquire()
+                    has_slot = True
+                song = await self.resolve_song(*track, snippet_duration_in_sec)
+                if song:
+                    if self.catalogue is not None:
+                        # sqlite writes block, the starts are already computed by resolve_song
+                        await asyncio_to_thread(self.catalogue.put, song)
+                    song.position = position
+                    await song_queue.put(song)
+            except CircuitOpenError as coe:
+                # youtube is unreachable for now, not this track: wait for the breaker's trial
+                # call without holding a slot and try the track again
+                if has_slot:
+                    prefetch_slots.release()
+                    has_slot = False
+                self.dump_info().log(f'Postponing "{track[1]}" by {coe.retry_after_in_sec:.0f}s: {coe}')
+                await asyncio_sleep(coe.retry_after_in_sec)
+                track_queue.put_nowait((position, track))
+            except Exception as e:
+                self.dump_info().log(f'Skipping "{track[1]}": {e}', important = True)
+            finally:
+                # unresolved tracks do not occupy a slot of the look-ahead window
+                if has_slot and not song:
+                    prefetch_slots.release()
+                track_queue.task_done()
+    
+    async def resolve_song(
+                self, 
+                uri_as_key, 
+                sp_track_name, 
+                sp_track_artists, 
+                sp_track_duration, 
+                sp_track_popularity,
+                snippet_duration_in_sec):
+        # search tracks on yt
+        yt_vid_id, yt_vid_name = await self.yt_handler.search_async(sp_track_name, cache_key = uri_as_key)
+        if not yt_vid_id:
+            self.dump_info().log(f'No Youtube video found for "{sp_track_name}".')
+            return None
 
+        # choose popular moments
+        with self.dump_info(f'Grab Popularity from Youtube for "{yt_vid_name}"'):
+            popularity_graph = await self.yt_handler.get_most_replayed(yt_vid_id, sp_track_duration)
+            if not popularity_graph:
+                self.dump_info().log(f'No popularity graph for "{yt_vid_name}".')
+                return None
+            snippet_starts = self.sliding_windows(
+                                    popularity_graph, 
+                                    sorted({snippet_duration_in_sec, *self.get_window_sizes()}))
 
-            if counter == 1:
-                break # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<------------------------ testing
+        return Song(
+                    uri_as_key,
+                    sp_track_name,
+                    sp_track_artists,
+                    sp_track_duration,
+                    sp_track_popularity,
+                    yt_vid_id,
+                    yt_vid_name,
+                    popularity_graph,
+                    snippet_starts[snippet_duration_in_sec],
+                    snippet_starts = snippet_starts)
+    
+    def get_window_sizes(self):
+        # snippet lengths every resolved song gets a start for, so that the catalogue can store
+        # them as they are; others are computed on demand
+        from src.SnippetCatalogue import SnippetCatalogue
+        
+        if self.catalogue is not None:
+            return self.catalogue.window_sizes_in_sec
+        return SnippetCatalogue.WINDOW_SIZES_IN_SEC
     
     def sliding_window(self, graph, window_size_in_sec):
-        from pandas import DataFrame as pd_DataFrame
-        from pandas import offsets as pd_offsets
-        from pandas import to_datetime as pd_to_datetime
+        return self.sliding_windows(graph, [window_size_in_sec])[window_size_in_sec]
+    
+    def sliding_windows(self, graph, window_sizes_in_sec):
+        # best start for every window size from one pass over the graph
+        from src.popularity import find_best_windows
         
-        graph_x_is_regular = graph.pop('is_regular')
-        df_graph = pd_DataFrame(data = graph)
-        df_graph.rename(columns = {'x': 'time', 'y': 'popularity'}, inplace=True)
-
-        self.dump_info().log(f'Choosing best moment from popularity graph.')
+        self.dump_info().log(f'Choosing best moments from popularity graph.')
 
         # selenium based extracted heatmaps have variable timestamps
         # requests based heatmaps are perfectly spaced
-        if not graph_x_is_regular:
-            # weighting popularity based on assigned duration since timeseries is irregular
-            df_graph['time_shift'] = (
-                    df_graph[['time']]
-                        .diff()                        # difference from one row to the next
-                        .set_index(df_graph.index - 1) # having the last index nan instead of the first
-            )
-            df_graph.fillna(0, inplace=True)
-            df_graph['scaled_popularity'] = df_graph['time_shift'] * df_graph['popularity'] # linear weighting
-        else:
-            df_graph['scaled_popularity'] = df_graph['popularity']
-                                        
-        df_windowed_popularity = (
-                df_graph 
-                    .set_index(pd_to_datetime(df_graph['time'].array, unit='ms'))['scaled_popularity']
-                    .rolling(window=f'{window_size_in_sec}s')
-                    .sum()
-                 )
-                    
-        # end of snippet because default of pd.rolling above is to write a resulting value in its 
-        # right-most df entry
-        snippet_end = df_windowed_popularity.idxmax()
-        window_dt = pd_offsets.Second(window_size_in_sec)
-                     
-        # automatically floor capped at 0
-        snippet_start = snippet_end - window_dt
-        self.dump_info().log(f'Found highest popularity at {snippet_start.minute}:{snippet_start.second}')
-        return (snippet_start.minute*60 + snippet_start.second) * 1000 
+        snippet_starts = find_best_windows(
+                                    graph.x, 
+                                    graph.y, 
+                                    [size * 1000 for size in window_sizes_in_sec], 
+                                    graph.is_regular)
+        snippet_starts = dict(zip(window_sizes_in_sec, snippet_starts.tolist()))
+        
+        for size, start in snippet_starts.items():
+            self.dump_info().log(f'Found highest popularity for {size}s at {start // 60000}:{start // 1000 % 60}')
+        return snippet_starts
 
 class MedleyContextManager():
     from src.utils import PrintLogger
 
-    def __init__(self, async_song_queue, _dump_info = PrintLogger.register('MedleyContextManager')):    
+    def __init__(
+                self, 
+                async_song_queue, 
+                policy = 'playlist', 
+                look_ahead = None, 
+                producer = None, 
+                snippet_duration_in_sec = None, 
+                highlights = 1, 
+                _dump_info = PrintLogger.register('MedleyContextManager')):    
         from datetime import datetime as dt 
+        from asyncio import Semaphore as asyncio_Semaphore
+        from src.SongScheduler import SongScheduler
         
         # is a dict to be able to pass it by reference: change the value inside the class
         # and see the change reflected by the passed out reference
         self.status = {'has_next_song': False}
+        # may be changed while playing; the next song starts at its best moment for the new length
+        self.status['snippet_duration_in_sec'] = snippet_duration_in_sec
         self.current_song = None
         self.next_song = None
 
@@ -175,48 +328,159 @@ class MedleyContextManager():
         self.dump_info = _dump_info
         self.song_queue = async_song_queue
         
+        # songs waiting to be played, ordered by the policy; every song is played once per round
+        self.policy = policy
+        self.scheduler = SongScheduler(policy)
+        
+        # round r plays the r-th best moment of every song
+        self.highlights = highlights
+        self.round = 0
+        
+        # prefetching: producer(prefetch_slots) resolves songs in the background while playing
+        self.producer = producer
+        self.producer_task = None
+        self.prefetch_slots = asyncio_Semaphore(look_ahead) if producer else None
+        
     async def __aenter__(self):
+        from asyncio import create_task as asyncio_create_task
+        
         self.status['has_next_song'] = True
-        return self.status, self.generator
+        if not self.producer:
+            return self.status, self.generator
+        
+        self.producer_task = asyncio_create_task(self.producer(self.prefetch_slots))
+        return self.status, self.prefetch_generator
 
     async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        from asyncio import gather as asyncio_gather
+        
+        if self.producer_task:
+            self.producer_task.cancel()
+            await asyncio_gather(self.producer_task, return_exceptions = True)
         if exc_type:
             print(exc_type, exc_value, exc_traceback)
+            
+    def add_song(self, song):
+        self.song_dict[song.uri] = song
+        is_new = self.scheduler.push(song)
+        if self.prefetch_slots and not is_new:
+            # duplicates in the playlist are not played again
+            self.prefetch_slots.release()
+        self.song_queue.task_done()
 
-    def choose_next_song(self):
+    def collect_songs(self):
         while not self.song_queue.empty():
-            song = self.song_queue.get_nowait()
-            self.song_dict[song.uri] = song
-            self.song_queue.task_done()
-            
-        for song in self.song_dict.values():
-            if (not song.last_played) or (song.last_played < self.medley_starting_time):
-                #self.dump_info().log(f'Choosing {song.name} as next song.')
-                self.next_song = song 
-                break
+            self.add_song(self.song_queue.get_nowait())
+
+    def choose_next_song(self):
+        self.collect_songs()
+        self.next_song = self.scheduler.pop()
+        if (not self.next_song) and self.start_next_round():
+            self.next_song = self.scheduler.pop()
+        elif self.next_song and self.prefetch_slots and (self.round == 0):
+            # the song leaves the look-ahead window; the producer may resolve the next one
+            self.prefetch_slots.release()
                 
         if not self.next_song:
             self.dump_info().log(f'No songs left.')
             self.status['has_next_song'] = False
 
+    def start_next_round(self):
+        # called once all songs are played and no more are coming: queues every song again that
+        # has another highlight for the current snippet length
+        from src.SongScheduler import SongScheduler
+        
+        snippet_duration_in_sec = self.status['snippet_duration_in_sec']
+        if (self.round + 1 >= self.highlights) or (not snippet_duration_in_sec):
+            return False
+        
+        self.round += 1
+        self.scheduler = SongScheduler(self.policy)
+        for song in self.song_dict.values():
+            if len(song.get_highlights(snippet_duration_in_sec, self.round + 1)) > self.round:
+                self.scheduler.push(song)
+        
+        self.dump_info().log(f'Starting round {self.round + 1} with {len(self.scheduler)} songs.')
+        return len(self.scheduler) > 0
+
+    def get_snippet_start(self, song):
+        snippet_duration_in_sec = self.status['snippet_duration_in_sec']
+        if not snippet_duration_in_sec:
+            return song.snippet_start_in_ms
+        if self.round == 0:
+            return song.get_snippet_start(snippet_duration_in_sec)
+        
+        # the snippet length may have changed since the round started
+        highlights = song.get_highlights(snippet_duration_in_sec, self.round + 1)
+        return highlights[min(self.round, len(highlights) - 1)]
+
     def generator(self):
         self.choose_next_song()
         
-        while(self.status['has_next_song']):# do something if song is not chosen yet
-            if not self.next_song:
-                pass
-
+        while(self.status['has_next_song']):
             self.current_song = self.next_song
             self.next_song = None
             
             self.dump_info().log(f'Returning {self.current_song.name}')
-            yield self.current_song.uri, self.current_song.snippet_start_in_ms
+            yield self.current_song.uri, self.get_snippet_start(self.current_song)
             
             from datetime import datetime as dt 
             self.current_song.last_played = dt.now()
             self.choose_next_song()
+            
+    async def wait_for_next_song(self):
+        # awaits a resolved song instead of giving up while the producer is still running
+        from asyncio import wait as asyncio_wait
+        from asyncio import ensure_future as asyncio_ensure_future
+        from asyncio import FIRST_COMPLETED as asyncio_FIRST_COMPLETED
+        
+        while True:
+            is_producer_done = self.producer_task.done()
+            self.collect_songs()
+            if len(self.scheduler) or is_producer_done:
+                break
+                
+            getter = asyncio_ensure_future(self.song_queue.get())
+            done, _ = await asyncio_wait({getter, self.producer_task}, return_when = asyncio_FIRST_COMPLETED)
+            if getter in done:
+                self.add_song(getter.result())
+            else:
+                getter.cancel()
+                
+        self.choose_next_song()
+        if is_producer_done and (not self.producer_task.cancelled()) and self.producer_task.exception():
+            self.dump_info().log(f'Gathering songs failed: {self.producer_task.exception()}', important = True)
+            
+    async def prefetch_generator(self):
+        await self.wait_for_next_song()
+        
+        while(self.status['has_next_song']):
+            self.current_song = self.next_song
+            self.next_song = None
+            
+            self.dump_info().log(f'Returning {self.current_song.name}')
+            yield self.current_song.uri, self.get_snippet_start(self.current_song)
+            
+            from datetime import datetime as dt 
+            self.current_song.last_played = dt.now()
+            await self.wait_for_next_song()
                 
 class Song():
+    # slotted: a catalogue holds thousands of songs; the graph is a Heatmap of float32 arrays
+    __slots__ = (
+                'uri', 
+                'name', 
+                'artists', 
+                'duration', 
+                'popularity', 
+                'yt_id', 
+                'yt_name', 
+                'graph', 
+                'snippet_start_in_ms', 
+                'last_played',
+                'position',
+                'snippet_starts',
+                'highlights')
     
     def __init__(self,
                 uri_as_key,
@@ -227,7 +491,9 @@ class Song():
                 yt_vid_id,
                 yt_vid_name,
                 popularity_graph,
-                snippet_start_in_ms):
+                snippet_start_in_ms,
+                position = None,
+                snippet_starts = None):
         
         self.uri = uri_as_key
         self.name = sp_track_name
@@ -239,6 +505,37 @@ class Song():
         self.graph = popularity_graph
         self.snippet_start_in_ms = snippet_start_in_ms
         self.last_played = None
+        # index in the playlist the song was taken from
+        self.position = position
+        # snippet length in sec -> best start in ms
+        self.snippet_starts = snippet_starts or {}
+        # snippet length in sec -> (k, starts of the k best non-overlapping windows)
+        self.highlights = {}
+        
+    def get_snippet_start(self, snippet_duration_in_sec):
+        # precomputed lengths are a lookup; others are scored once from the graph and kept
+        if snippet_duration_in_sec not in self.snippet_starts:
+            from src.popularity import find_best_window
+            self.snippet_starts[snippet_duration_in_sec] = find_best_window(
+                                                                self.graph.x, 
+                                                                self.graph.y, 
+                                                                snippet_duration_in_sec * 1000, 
+                                                                self.graph.is_regular)
+        return self.snippet_starts[snippet_duration_in_sec]
+    
+    def get_highlights(self, snippet_duration_in_sec, k):
+        # starts of the k best non-overlapping snippets, best first; fewer for short songs
+        k_computed, starts = self.highlights.get(snippet_duration_in_sec, (0, []))
+        if k_computed < k:
+            from src.popularity import find_top_windows
+            starts = find_top_windows(
+                            self.graph.x, 
+                            self.graph.y, 
+                            snippet_duration_in_sec * 1000, 
+                            k, 
+                            self.graph.is_regular)
+            self.highlights[snippet_duration_in_sec] = (k, starts)
+        return starts[:k]
         
 
         
\ No newline at end of file
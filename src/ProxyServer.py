@@ -1,50 +1,81 @@
-# https://proxybroker.readthedocs.io
+    # https://proxybroker.readthedocs.io
 
 class ProxyServer():
     from src.utils import PrintLogger
-    
+
     def __init__(
                     self,
-                    _async_handler, 
-                    proxy_file_path = None, 
-                    no_of_proxies = 5, 
+                    _async_handler,
+                    proxy_file_path = None,
+                    no_of_proxies = 5,
+                    check_interval_in_sec = 10,
+                    save_interval_in_sec = 60,
+                    max_proxy_age_in_sec = 24 * 60 * 60,
                     dump_info = PrintLogger.register('ProxyServer')):
-        
+
         if not proxy_file_path:
             proxy_file_path = 'PROXY_LIST.txt'
-            
+
         self.path = proxy_file_path
-        self.no_of_proxies = 5
+        self.no_of_proxies = no_of_proxies
+        self.check_interval_in_sec = check_interval_in_sec
+        self.save_interval_in_sec = save_interval_in_sec
+        self.max_proxy_age_in_sec = max_proxy_age_in_sec
         self.ash = _async_handler
         self.dump_info = dump_info
-        
+
         self.proxy_queue = self.ash.add_queue('proxies')
-        
+
+        # 'host:port' -> ProxyStats
+        self.pool = {}
+        self.pool_changed = None
+        self.finder_task = None
+        self.background_tasks = []
+
         from src.utils import install_pip_pkg
         install_pip_pkg({'proxybroker'})
         import warnings
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", category=DeprecationWarning)
             from proxybroker import Broker
-        
+
         self.broker = Broker(self.proxy_queue)
-            
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.dump_info().log('Exiting ProxyServer')     
+        self.dump_info().log('Exiting ProxyServer')
+        for task in self.background_tasks:
+            task.cancel()
+        self.save_proxies()
         if exc_type:
             print(exc_type, exc_value, exc_traceback)
-            
+
+    async def start(self):
+        # keeps the pool topped up in the background instead of only when it runs dry
+        from asyncio import Event as asyncio_Event
+        from asyncio import create_task as asyncio_create_task
+
+        if self.background_tasks:
+            return
+
+        self.pool_changed = asyncio_Event()
+
+        # warm start: known proxies are usable right away and checked again in the background
+        loaded = self.load_proxies()
+        self.background_tasks = [
+            asyncio_create_task(self.collect_proxies()),
+            asyncio_create_task(self.maintain_pool(revalidate = loaded))]
+
     async def get_a_proxy(self):
         """
         Get proxies from proxy queue until queue is empty.
         """
         self.dump_info().log(f'Proxy queue has currently {self.proxy_queue.qsize()} items.')
-        
-        while True: #not self.proxy_queue.empty():         
+
+        while True: #not self.proxy_queue.empty():
             self.dump_info().log('Waiting to receive proxies.')
             proxy = await self.proxy_queue.get()
             self.proxy_queue.task_done()
-            
+
             if proxy and proxy.is_working:
                 protocol = 'https'
                 line = f'{protocol}://{proxy.host}:{proxy.port}'
@@ -52,27 +83,240 @@ class ProxyServer():
             else:
                 self.dump_info().log(f'Disregarding invalid proxy {proxy} .')
 
-    async def get_proxy(self):
-        from src.AsyncHandler import AsyncHandler as ash
+    async def collect_proxies(self):
+        async for proxy_string in self.get_a_proxy():
+            ip, port = self.read_proxy_string(proxy_string)
+            self.add_proxy(ip, port)
+
+    def add_proxy(self, ip, port, latency_in_sec = None):
+        from time import time
+
+        key = f'{ip}:{port}'
+        if key in self.pool:
+            self.pool[key].is_verified = True
+            self.pool[key].last_seen = time()
+            return self.pool[key]
+
+        self.pool[key] = ProxyStats(ip, port, latency_in_sec)
+        self.dump_info().log(f'Added proxy {key} to the pool ({len(self.pool)} proxies).')
+        if self.pool_changed:
+            self.pool_changed.set()
+        return self.pool[key]
+
+    def get_available(self):
+        from time import monotonic
+        now = monotonic()
+        return [stats for stats in self.pool.values() if not stats.is_quarantined(now)]
+
+    async def maintain_pool(self, revalidate = None):
+        from time import monotonic
+        from asyncio import sleep as asyncio_sleep
+
+        if revalidate:
+            await self.revalidate_proxies(revalidate)
+
+        last_saved = monotonic()
+        while True:
+            if (len(self.get_available()) < self.no_of_proxies) and \
+                        ((not self.finder_task) or self.finder_task.done()):
+                await self.find_proxies()
+
+            if monotonic() - last_saved >= self.save_interval_in_sec:
+                self.save_proxies()
+                last_saved = monotonic()
+            await asyncio_sleep(self.check_interval_in_sec)
+
+    async def revalidate_proxies(self, proxies):
+        with self.dump_info(f'Re-validating {len(proxies)} stored proxies.'):
+            self.finder_task = self.ash.create_task(self.broker.find(
+                                    types=['HTTPS'],
+                                    # raw text is parsed by proxybroker itself; a list would
+                                    # have to hold (host, port) tuples
+                                    data = '\n'.join(f'{stats.ip}:{stats.port}' for stats in proxies),
+                                    limit = len(proxies)))
+            await self.finder_task
+            await self.proxy_queue.join()
+
+        # working proxies came back through the queue; the others get a strike
+        for stats in proxies:
+            if not stats.is_verified:
+                self.report_failure(stats.ip, stats.port)
+
+    def load_proxies(self):
+        # one line per proxy: 'https://host:port {stats as json}'
+        import os
+        from time import time
+
+        if not os.path.isfile(self.path):
+            return []
+
+        loaded = []
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    proxy_string, _, stats_string = line.partition(' ')
+                    ip, port = self.read_proxy_string(proxy_string)
+                    stats = ProxyStats.from_line(ip, port, stats_string)
+                except ValueError as ve:
+                    self.dump_info().log(f'Skipping unreadable line in {self.path}: {line}')
+                    continue
+
+                if time() - stats.last_seen > self.max_proxy_age_in_sec:
+                    continue
+                self.pool[f'{ip}:{port}'] = stats
+                loaded.append(stats)
+
+        self.dump_info().log(f'Loaded {len(loaded)} proxies from {self.path}.')
+        return loaded
+
+    def save_proxies(self):
+        import os
+
+        # written to a temporary file first so that a crash cannot leave a truncated list behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for stats in self.pool.values():
+                f.write(f'https://{stats.ip}:{stats.port} {stats.to_line()}\n')
+        os.replace(tmp_path, self.path)
+
+    async def get_proxy(self, exclude = ()):
+        # exclude: (ip, port) of proxies already in use elsewhere; only handed out again
+        # if there is no other choice
+        from time import monotonic
+        from asyncio import wait_for as asyncio_wait_for
+        from asyncio import TimeoutError as asyncio_TimeoutError
+
+        await self.start()
+
+        while True:
+            available = self.get_available()
+            if available:
+                unused = [stats for stats in available if (stats.ip, stats.port) not in exclude]
+                best = max(unused or available, key = lambda stats: stats.score())
+                best.last_used = monotonic()
+                return best.ip, best.port
+
+            # wake up when a proxy is added or the first quarantine is over
+            self.dump_info().log('Waiting to receive proxies.')
+            if (not self.finder_task) or self.finder_task.done():
+                await self.find_proxies()
+
+            now = monotonic()
+            quarantines = [stats.quarantined_until - now for stats in self.pool.values()]
+            self.pool_changed.clear()
+            try:
+                await asyncio_wait_for(
+                        self.pool_changed.wait(),
+                        timeout = min(quarantines + [self.check_interval_in_sec]))
+            except asyncio_TimeoutError:
+                pass
+
+    def report_success(self, ip, port, latency_in_sec):
+        stats = self.pool.get(f'{ip}:{port}')
+        if stats:
+            stats.report_success(latency_in_sec)
+
+    def report_failure(self, ip, port, is_captcha = False):
+        stats = self.pool.get(f'{ip}:{port}')
+        if not stats:
+            return
+
+        stats.report_failure(is_captcha)
+        if stats.backoff_level > ProxyStats.MAX_BACKOFF_LEVEL:
+            self.dump_info().log(f'Dropping proxy {ip}:{port} after {stats.backoff_level} failures in a row.')
+            del self.pool[f'{ip}:{port}']
+        else:
+            self.dump_info().log(f'Quarantining proxy {ip}:{port} for {stats.backoff_in_sec():.0f}s.')
 
-        proxy_string = await ash.yielder(self.get_a_proxy)
-        while not proxy_string:
-            await self.find_proxies()
-            proxy_string = await ash.yielder(self.get_a_proxy)
-         
-        return self.read_proxy_string(proxy_string)
-    
     def read_proxy_string(self, proxy_str):
         # i.e. proxy_str = 'https://163.116.131.129:8080'
-        [ip, port] = proxy_str.lstrip('https://').split(':') 
+        [ip, port] = proxy_str.split('://')[-1].split(':')
         port = int(port)
         return ip, port
-    
+
     async def find_proxies(self):
         european_country_codes = ['DE', 'AT', 'FR', 'UK', 'IT', 'HU', 'IE', 'GR', 'LV', 'LT', 'NL', 'PL', 'RO', 'SK', 'SI', 'ES', 'SE', 'BE', 'BG', 'HR', 'DK', 'EE', 'FI']
         with self.dump_info('Searching for new proxies.'):
-            producer = self.ash.create_task(self.broker.find(
-                                    types=['HTTPS'], 
-                                    limit= self.no_of_proxies, 
+            self.finder_task = self.ash.create_task(self.broker.find(
+                                    types=['HTTPS'],
+                                    limit= self.no_of_proxies,
                                     countries = european_country_codes))
-            #await producer
\ No newline at end of file
+            #await producer
+
+class ProxyStats():
+    '''
+    Health record of one proxy. Failures quarantine the proxy with exponential backoff;
+    a success lifts the backoff again.
+    '''
+
+    BASE_BACKOFF_IN_SEC = 30
+    MAX_BACKOFF_LEVEL = 6
+    LATENCY_SMOOTHING = 0.3
+
+    def __init__(self, ip, port, latency_in_sec = None):
+        from time import time
+
+        self.ip = ip
+        self.port = port
+        self.latency_in_sec = latency_in_sec if latency_in_sec else 1.0
+        self.successes = 0
+        self.failures = 0
+        self.captchas = 0
+        self.backoff_level = 0
+        self.quarantined_until = 0
+        self.last_used = 0
+        # wall clock time of the last sign of life; survives restarts
+        self.last_seen = time()
+        self.is_verified = True
+
+    PERSISTED = ('latency_in_sec', 'successes', 'failures', 'captchas', 'last_seen')
+
+    def to_line(self):
+        from json import dumps as json_dumps
+        return json_dumps({key: getattr(self, key) for key in self.PERSISTED})
+
+    @classmethod
+    def from_line(cls, ip, port, line):
+        from json import loads as json_loads
+
+        stats = cls(ip, port)
+        # json.JSONDecodeError is a ValueError
+        values = json_loads(line) if line else {}
+        for key in cls.PERSISTED:
+            if key in values:
+                setattr(stats, key, values[key])
+        stats.is_verified = False
+        return stats
+
+    def is_quarantined(self, now):
+        return self.quarantined_until > now
+
+    def backoff_in_sec(self):
+        return self.BASE_BACKOFF_IN_SEC * 2 ** (self.backoff_level - 1)
+
+    def score(self):
+        # laplace smoothed so that new proxies get a chance
+        requests = self.successes + self.failures
+        success_rate = (self.successes + 1) / (requests + 2)
+        captcha_rate = self.captchas / (requests + 1)
+        return success_rate * (1 - captcha_rate) / (self.latency_in_sec + 0.1)
+
+    def report_success(self, latency_in_sec):
+        from time import time
+
+        self.last_seen = time()
+        self.successes += 1
+        self.backoff_level = 0
+        self.latency_in_sec += self.LATENCY_SMOOTHING * (latency_in_sec - self.latency_in_sec)
+
+    def report_failure(self, is_captcha = False):
+        from time import monotonic
+
+        self.failures += 1
+        if is_captcha:
+            self.captchas += 1
+        self.backoff_level += 1
+        self.quarantined_until = monotonic() + self.backoff_in_sec()
@@ -3,10 +3,32 @@ from src.YoutubeHandler import YoutubeHandler
 class RequestsYTHandler(YoutubeHandler):
     from src.utils import PrintLogger
     
-    def __init__(self, dump_info = PrintLogger.register('RequestsYTHandler'), *args, **kwargs):
-        self.response = None
-        self.session = None
-        super().__init__(dump_info = dump_info, *args, **kwargs)
+    provides_heat_markers = True
+    
+    def __init__(
+                    self, 
+                    dump_info = PrintLogger.register('RequestsYTHandler'), 
+                    heatmap_cache_path = 'HEATMAP_CACHE.sqlite', 
+                    heatmap_cache_ttl_in_sec = 7 * 24 * 60 * 60,
+                    heatmap_cache_max_entries = 10000,
+                    no_of_shards = 3,
+                    min_request_interval_in_sec = 2.0,
+                    *args, **kwargs):
+        # one session per proxy and user agent; requests are spread over them
+        self.shards = []
+        self.no_of_shards = no_of_shards
+        self.min_request_interval_in_sec = min_request_interval_in_sec
+        
+        heatmap_cache = None
+        if heatmap_cache_path:
+            from src.CacheHandler import CacheHandler
+            heatmap_cache = CacheHandler(
+                                    heatmap_cache_path, 
+                                    table = 'heatmaps', 
+                                    ttl_in_sec = heatmap_cache_ttl_in_sec,
+                                    max_entries = heatmap_cache_max_entries)
+            
+        super().__init__(dump_info = dump_info, heatmap_cache = heatmap_cache, *args, **kwargs)
     
     def __exit__(self, exc_type, exc_value, exc_traceback):
         
@@ -14,100 +36,250 @@ class RequestsYTHandler(YoutubeHandler):
         del self.dump_info
         self.dump_info = None
         
-        del self.response
-        self.response = None
-        
         super().__exit__(exc_type, exc_value, exc_traceback)
    
     def quit_connection(self):
-        self.session.close()
-        del self.session
-        self.session = None
+        for shard in self.shards:
+            if shard.session:
+                self.close_session(shard.session)
+        self.shards = []
             
-    def init_session(self):
+    def create_session(self):
         import requests
-        self.session = requests.Session()
+        return requests.Session()
+    
+    def close_session(self, session):
+        session.close()
         
     async def setup_connection(self):
-        if self.session:
+        if self.shards:
             self.quit_connection()
         
-        self.init_session()
-        await super().setup_connection()
+        self.shards = [FetchShard(self.min_request_interval_in_sec) for _ in range(self.no_of_shards)]
+        for shard in self.shards:
+            await self.rotate_shard(shard)
+            
+    async def rotate_shard(self, shard):
+        # new proxy and user agent; the session is replaced as well to drop the cookies of the old identity
+        if shard.session:
+            self.close_session(shard.session)
+        shard.session = self.create_session()
+        
+        in_use = {other.proxy_address for other in self.shards if other is not shard}
+        proxy_ip, proxy_port = await self.proxy_handler.get_proxy(exclude = in_use)
+        self.set_proxy_for_running(proxy_ip, proxy_port, shard)
+        self.set_user_agent_for_running(self.get_random_user_agent(), shard)
+        self.dump_info().log(f'Shard {self.shards.index(shard)} uses proxy = https://{proxy_ip}:{proxy_port}.')
+        
+    def pick_shard(self):
+        # the shard that may send the soonest, then the least busy one
+        return min(self.shards, key = lambda shard: (shard.rate_limiter.next_slot, shard.in_flight))
         
-    def set_proxy_for_running(self, proxy_ip, proxy_port):
+    def set_proxy_for_running(self, proxy_ip, proxy_port, shard = None):
+        if not shard:
+            shard = self.shards[0]
+            
         # format "http://10.10.1.11:1080"
         # has to be 'http' even for https
-        proxy_string = f'http://{proxy_ip}:{proxy_port}'
-        proxy = {'https': proxy_string, 'http': proxy_string}
-
-        self.session.proxies = proxy
+        shard.proxy = f'http://{proxy_ip}:{proxy_port}'
+        shard.proxy_address = (proxy_ip, proxy_port)
         return True
             
-    def set_user_agent_for_running(self, user_agent):        
+    def set_user_agent_for_running(self, user_agent, shard = None):        
+        if not shard:
+            shard = self.shards[0]
+            
         # user agent
-        headers = {'user-agent': user_agent}
-        self.session.headers.update(headers)
-        
+        shard.headers = {'user-agent': user_agent}
         return True
         
-    async def get(self, url, retries = 0):
+    async def get(self, url, read = None):
         from requests.exceptions import ProxyError
         from requests.exceptions import ConnectionError
-        import requests 
+        from requests.exceptions import RequestException
+        from src.RetryHandler import RetryableError
+        from time import monotonic
+        from asyncio import to_thread as asyncio_to_thread
 
-        self.response = None
-        while not self.response:
+        async def attempt():
+            shard = self.pick_shard()
             try:
-                self.response = requests.get(url, timeout=10)
+                # released in finally even if cancelled while waiting for the slot
+                await shard.acquire()
+                started = monotonic()
+                # streamed: the body is only read as far as get_heat_markers needs it
+                response = await asyncio_to_thread(
+                                        shard.session.get,
+                                        url, 
+                                        proxies = {'https': shard.proxy, 'http': shard.proxy},
+                                        headers = shard.headers,
+                                        timeout=10, 
+                                        stream=True)
             except ProxyError as pe:
-                if retries < 3:
-                    self.dump_info().log('Changing proxy.')
-                    super().set_proxy_for_running()
-                self.response = None
+                self.report_proxy_failure(proxy_address = shard.proxy_address)
+                self.dump_info().log('Changing proxy.')
+                await self.rotate_shard(shard)
+                raise RetryableError('Proxy Error.')
             except ConnectionError as ce:
-                self.dump_info().log('Connection Error.', important=True)
+                self.report_proxy_failure(proxy_address = shard.proxy_address)
+                raise RetryableError('Connection Error.')
+            finally:
+                shard.release()
 
-            if self.response and (retries < 3) and (self.response.url != url):     # redirected to captcha
+            if response.url != url:     # redirected to captcha
                 self.dump_info().log('Ran into captcha police. New proxy and user agent.')
-                await super().setup_connection()
-                self.response = None
+                self.report_proxy_failure(is_captcha = True, proxy_address = shard.proxy_address)
+                response.close()
+                await self.rotate_shard(shard)
+                raise RetryableError('Captcha.')
+            
+            if read:
+                try:
+                    response = await read(response)
+                except RequestException as re:
+                    # i.e. ChunkedEncodingError or a read timeout
+                    self.report_proxy_failure(proxy_address = shard.proxy_address)
+                    raise RetryableError('Connection Error while reading.')
+            
+            self.report_proxy_success(monotonic() - started, proxy_address = shard.proxy_address)
+            return response
                 
-            # if an error occurs above, the flow enters here and increases retries counter
-            if not self.response:
-                if retries >=3:  
-                    raise RuntimeError(f'Could not load {url=}')
-                else:
-                    self.dump_info().log(f'Reloading: {retries + 1}. retry.')
-                    retries += 1
-                    await self.get(url, retries = retries)
+        return await self.retry_handler.run(attempt, url)
     
-    async def get_heatmaps_from_yt(self, total_duration_in_ms):
-        # cannot use json directly on full response; regex search first
-        from re import findall as re_findall
+    async def get_heatmaps_from_yt(self, total_duration_in_ms, response = None):
+        heat_markers = await self.get_heat_markers(response)
+        if heat_markers is None:
+            return None
         
-        # following https://github.com/Benjamin-Loison/YouTube-operational-API/blob/13e620da9a64ea775fb655dbac2290f86aec4e05/tools/DisplayMostReplayedGraph.py
-        pattern = r'{"heatMarkerRenderer":{"timeRangeStartMillis":(\d+),"markerDurationMillis":(\d+),"heatMarkerIntensityScoreNormalized":(\d+.\d+)}}'
-        yt_string = self.response.text
+        return self.build_graph_from_markers(heat_markers, total_duration_in_ms)
         
-        matches = re_findall(pattern, yt_string)
-        if (not matches) or (len(matches) == 0):
+    async def get_heat_markers(self, response, chunk_size = 16 * 1024):
+        from asyncio import to_thread as asyncio_to_thread
+        
+        scanner = HeatMarkerScanner()
+        def scan():
+            # iter_content blocks on the socket, so the page is read off the event loop
+            try:
+                for chunk in response.iter_content(chunk_size = chunk_size):
+                    if scanner.feed(chunk):
+                        break
+            finally:
+                # drops the rest of the page once the last marker is parsed
+                response.close()
+                
+        await asyncio_to_thread(scan)
+        return scanner.get_heat_markers()
+        
+    def parse_heat_markers(self, yt_string):
+        scanner = HeatMarkerScanner()
+        scanner.feed(yt_string.encode() if isinstance(yt_string, str) else yt_string)
+        return scanner.get_heat_markers()
+    
+    def build_graph_from_markers(self, heat_markers, total_duration_in_ms):
+        from src.popularity import build_heatmap_from_markers
+        return build_heatmap_from_markers(heat_markers, total_duration_in_ms)
+
+class HeatMarkerScanner():
+    '''
+    Incremental parser for the heatMarkerRenderer entries of a youtube watch page. Chunks of the
+    page are fed in as they arrive; feed returns True once the list of markers is complete so
+    that the rest of the page does not need to be downloaded.
+    Before the first marker only a short tail of the page is kept in memory.
+    '''
+    from re import compile as re_compile
+    
+    # following https://github.com/Benjamin-Loison/YouTube-operational-API/blob/13e620da9a64ea775fb655dbac2290f86aec4e05/tools/DisplayMostReplayedGraph.py
+    anchor = b'{"heatMarkerRenderer":'
+    pattern = re_compile(rb'{"heatMarkerRenderer":{"timeRangeStartMillis":(\d+),"markerDurationMillis":(\d+),"heatMarkerIntensityScoreNormalized":(\d+(?:\.\d+)?)}}')
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.has_started = False
+        self.is_done = False
+        self.expects_separator = False
+        self.matches = []
+        
+    def feed(self, chunk):
+        if self.is_done:
+            return True
+        
+        self.buffer += chunk
+        if not self.has_started:
+            start = self.buffer.find(self.anchor)
+            if start == -1:
+                # the anchor might be split between two chunks
+                del self.buffer[:-len(self.anchor)]
+                return False
+            
+            self.has_started = True
+            del self.buffer[:start]
+            
+        while True:
+            # markers are separated by ',' and the list is closed by ']'
+            if self.expects_separator:
+                if self.pos == len(self.buffer):
+                    break
+                if self.buffer[self.pos] != ord(','):
+                    self.is_done = True
+                    break
+                self.pos += 1
+                self.expects_separator = False
+                
+            match = self.pattern.match(self.buffer, self.pos)
+            if not match:
+                # an incomplete marker needs the next chunk; only the closing ']' ends the list
+                end = self.buffer.find(b'}}', self.pos)
+                if end == -1:
+                    break
+                if not self.matches:
+                    # anchor without the expected fields; keep looking further down the page
+                    self.has_started = False
+                    del self.buffer[:self.pos + 1]
+                    self.pos = 0
+                    return self.feed(b'')
+                # a marker with unexpected fields is skipped, the ones after it still count
+                self.pos = end + len(b'}}')
+                self.expects_separator = True
+                continue
+                
+            self.matches.append(match.groups())
+            self.pos = match.end()
+            self.expects_separator = True
+            
+        del self.buffer[:self.pos]
+        self.pos = 0
+        return self.is_done
+    
+    def get_heat_markers(self):
+        from numpy import array as np_array
+        
+        if not self.matches:
             return None
         
-        (time_start_in_ms, duration_in_ms, score) = \
-                            list(zip(*[(float(a), float(b), float(c)) for a,b,c in matches]))
+        # rows: time_start_in_ms, duration_in_ms, score
+        return np_array(self.matches, dtype = float).T
+
+class FetchShard():
+    '''
+    One session bound to its own proxy and user agent. Requests through a shard are spaced by
+    at least min_interval_in_sec so that a single exit ip does not run into captchas.
+    '''
+    
+    def __init__(self, min_interval_in_sec):
+        from src.RetryHandler import RateLimiter
         
-        max_time = time_start_in_ms[-1] + duration_in_ms[-1]
+        self.session = None
+        self.proxy = None
+        self.proxy_address = None
+        self.headers = {}
         
-        graph = {}
-        # converting to seconds
-        graph['x'] = list(map(lambda x: x / max_time * total_duration_in_ms, time_start_in_ms))
-        graph['y'] = score
+        self.rate_limiter = RateLimiter(min_interval_in_sec)
+        self.in_flight = 0
         
-        from numpy import std as np_std
-        if np_std(duration_in_ms) == 0:
-            graph['is_regular'] = True
-        else:
-            graph['is_regular'] = False
+    async def acquire(self):
+        self.in_flight += 1
+        await self.rate_limiter.wait_async()
             
-        return graph
+    def release(self):
+        self.in_flight -= 1
@@ -0,0 +1,163 @@
+class RetryableError(Exception):
+    '''
+    Raised by an attempt passed to RetryHandler.run when trying again can help, i.e. on proxy
+    errors, connection errors or captcha redirects.
+    '''
+    pass
+
+class CircuitOpenError(RuntimeError):
+    '''
+    Raised by RetryHandler.run while the circuit is open. Nothing was tried; the call may be repeated
+    after retry_after_in_sec, when the next trial call is due.
+    '''
+    def __init__(self, message, retry_after_in_sec):
+        RuntimeError.__init__(self, message)
+        self.retry_after_in_sec = retry_after_in_sec
+
+class RetryHandler():
+    '''
+    Runs attempts with exponential backoff and full jitter under a total deadline per call.
+    Consecutive failures across all calls open a circuit breaker: further calls fail right away
+    until reset_timeout_in_sec has passed, after which a single trial call decides whether the
+    circuit closes again.
+    '''
+    from src.utils import PrintLogger
+
+    def __init__(
+                    self,
+                    max_retries = 3,
+                    base_delay_in_sec = 0.5,
+                    max_delay_in_sec = 10,
+                    deadline_in_sec = 60,
+                    failure_threshold = 10,
+                    reset_timeout_in_sec = 60,
+                    dump_info = PrintLogger.register('RetryHandler')):
+        self.max_retries = max_retries
+        self.base_delay_in_sec = base_delay_in_sec
+        self.max_delay_in_sec = max_delay_in_sec
+        self.deadline_in_sec = deadline_in_sec
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_sec = reset_timeout_in_sec
+        self.dump_info = dump_info
+
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.is_trial_running = False
+
+    def get_delay(self, retry):
+        from random import uniform
+        return uniform(0, min(self.max_delay_in_sec, self.base_delay_in_sec * 2 ** retry))
+
+    def check_circuit(self, description):
+        from time import monotonic
+
+        if self.opened_at is None:
+            return False
+
+        # half-open: one trial call at a time once the reset timeout is over
+        retry_after_in_sec = self.opened_at + self.reset_timeout_in_sec - monotonic()
+        if (retry_after_in_sec > 0) or self.is_trial_running:
+            # while a trial is running its outcome is awaited for a moment
+            raise CircuitOpenError(
+                        f'Circuit open after {self.consecutive_failures} failures; not loading {description}',
+                        max(retry_after_in_sec, self.base_delay_in_sec))
+        self.is_trial_running = True
+        return True
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        from time import monotonic
+
+        self.consecutive_failures += 1
+        if (self.consecutive_failures >= self.failure_threshold) or (self.opened_at is not None):
+            if self.opened_at is None:
+                self.dump_info().log(f'Opening circuit after {self.consecutive_failures} failures in a row.', important = True)
+            self.opened_at = monotonic()
+
+    async def run(self, attempt, description = ''):
+        '''
+        Awaits attempt() until it returns without raising RetryableError. Gives up with a
+        RuntimeError after max_retries retries or once the deadline has passed.
+        '''
+        from time import monotonic
+        from asyncio import sleep as asyncio_sleep
+        from asyncio import wait_for as asyncio_wait_for
+        from asyncio import TimeoutError as asyncio_TimeoutError
+
+        is_trial = self.check_circuit(description)
+        deadline = monotonic() + self.deadline_in_sec
+        last_error = None
+        try:
+            for retry in range(self.max_retries + 1):
+                try:
+                    result = await asyncio_wait_for(attempt(), timeout = max(deadline - monotonic(), 0))
+                except asyncio_TimeoutError as te:
+                    self.record_failure()
+                    last_error = te
+                    break
+                except RetryableError as re:
+                    self.record_failure()
+                    last_error = re
+                    if self.opened_at is not None:
+                        break
+
+                    delay = self.get_delay(retry)
+                    if (retry == self.max_retries) or (monotonic() + delay >= deadline):
+                        break
+                    self.dump_info().log(f'{re} Reloading: {retry + 1}. retry in {delay:.1f}s.')
+                    await asyncio_sleep(delay)
+                    continue
+
+                self.record_success()
+                return result
+        finally:
+            if is_trial:
+                self.is_trial_running = False
+
+        raise RuntimeError(f'Could not load {description}') from last_error
+
+class RateLimiter():
+    '''
+    Spaces requests by at least min_interval_in_sec; block_until holds back every request until a
+    point in time, e.g. for a Retry-After. Callers on the event loop await wait_async, those on
+    worker threads call wait; both draw from the same slots.
+    '''
+
+    def __init__(self, min_interval_in_sec):
+        from threading import Lock
+
+        self.min_interval_in_sec = min_interval_in_sec
+        self.next_slot = 0
+        self.blocked_until = 0
+        self.lock = Lock()
+
+    def reserve(self):
+        # the slot is reserved before waiting so that concurrent callers queue up behind each other
+        from time import monotonic
+
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot, self.blocked_until)
+            self.next_slot = slot + self.min_interval_in_sec
+        return slot - now
+
+    def wait(self):
+        from time import sleep
+
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+
+    async def wait_async(self):
+        from asyncio import sleep as asyncio_sleep
+
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio_sleep(delay)
+
+    def block_until(self, until):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, until)
@@ -106,24 +106,23 @@ class SeleniumHandler(YoutubeHandler):
         else:
             return True
         
-    async def get(self, url, retries = 0):
+    async def get(self, url):
         from selenium.common.exceptions import WebDriverException, InvalidSessionIdException
+        from src.RetryHandler import RetryableError
         
-        try:
-            self.ff_webdriver.get(url)
-        except InvalidSessionIdException as is_exc:
-            self.dump_info().log('Re-opening browser.')
-            self.setup_connection()
-            await self.get(url)
-            
-        except WebDriverException as wd_exc:
-            self.dump_info().log(f'Reloading: {retries + 1}. retry.')
-            if retries >=3:  
-                raise wd_exc
-            else:
-                retries += 1
+        async def attempt():
+            try:
+                self.ff_webdriver.get(url)
+            except InvalidSessionIdException as is_exc:
+                self.dump_info().log('Re-opening browser.')
+                await self.setup_connection()
+                raise RetryableError('Browser session lost.')
+            except WebDriverException as wd_exc:
                 await YoutubeHandler.set_proxy_for_running(self)
-                await self.get(url, retries = retries)
+                raise RetryableError(f'WebDriverException {wd_exc.msg}.')
+            return url
+            
+        return await self.retry_handler.run(attempt, url)
 
     async def locate_by_css(self, css_string, attribute_string):
         from selenium.webdriver.common.by import By 
@@ -164,46 +163,25 @@ class SeleniumHandler(YoutubeHandler):
         result = [i.get_attribute(attribute_string) for i in result]
         return result
         
-    async def get_heatmaps_from_yt(self, total_duration_in_ms):            
+    async def get_heatmaps_from_yt(self, total_duration_in_ms, response = None):            
         scrape_dict = {
             'heatmap' : ('.ytp-heat-map-path', 'd'),
             'chapters': ('.ytp-heat-map-chapter', 'style')
         }
         
         with self.dump_info(f'Attempting to scrape heat map.'):
-            heatmaps = await self.locate_by_css((scrape_dict['heatmap'])
+            heatmaps = await self.locate_by_css(*scrape_dict['heatmap'])
 
         with self.dump_info(f'Attempting to scrape chapter sizes.'):
-            chapter_times = await self.locate_by_css((scrape_dict['chapters'])
+            chapter_times = await self.locate_by_css(*scrape_dict['chapters'])
         
         return self.build_graph(chapter_times, heatmaps, total_duration_in_ms)
         
     def build_graph(self, chapter_times, heatmaps, total_duration_in_ms):
-        from re import findall as re_findall
-        from re import match as re_match
+        from src.popularity import build_heatmap_from_paths
         
-        graph = {'x': [], 'y': []}
-        for i, time in enumerate(chapter_times):
-            # do not represent actual ms times but px factors inside of youtube's progress bar
-            duration_factor, offset_factor = re_match(r'width: (\d+)px; left: (\d+)px;', time).group(1, 2)  
-
-            # regex for x,y pairs; first pair is always 0.0,100.0 
-            # the last pair is something weird; seems out of bounds
-            coords = re_findall(r'\s([\d.]+,[\d.]+)\s', heatmaps[i])[1:]
-
-            # split into x and y list
-            coords = list(zip(*[coord.split(',') for coord in coords]))
-
-            #print(duration_factor, offset_factor,coords[0][2], coords[0][-2])
-            self.dump_info().log(f'Assembling popularity graph. Last tuple for chapter: {coords[0][-1]},{coords[1][-1]}')
-            tmp = [(float(i) * float(duration_factor) / 1000.0) + float(offset_factor) for i in coords[0]]
-            graph['x'].extend(tmp)
-            graph['y'].extend([100.0 - float(i) for i in coords[1]])
-
-        assert graph['x'][-1] == max(graph['x'])
-        graph['x'] = [i * total_duration_in_ms / graph['x'][-1] for i in graph['x']]
-        graph['is_regular'] = False
-        return graph 
+        self.dump_info().log(f'Assembling popularity graph from {len(chapter_times)} chapters.')
+        return build_heatmap_from_paths(chapter_times, heatmaps, total_duration_in_ms)
     
     # deprecated
     async def set_proxy_options(self, ip, port):
@@ -0,0 +1,157 @@
+def score_page(page, total_duration_in_ms, window_size_in_sec):
+    '''
+    Everything cpu bound between a youtube watch page and its snippet start; runs in a worker
+    process of SnippetBatch. page is either the raw page (bytes) or its already parsed heat markers.
+    Returns (heat_markers, heatmap, snippet_start_in_ms) or None if the page has no heatmap.
+    '''
+    from src.RequestsYTHandler import HeatMarkerScanner
+    from src.popularity import build_heatmap_from_markers, find_best_window
+
+    heat_markers = page
+    if isinstance(page, bytes):
+        scanner = HeatMarkerScanner()
+        scanner.feed(page)
+        heat_markers = scanner.get_heat_markers()
+    if heat_markers is None:
+        return None
+
+    graph = build_heatmap_from_markers(heat_markers, total_duration_in_ms)
+    snippet_start_in_ms = find_best_window(graph.x, graph.y, window_size_in_sec * 1000, graph.is_regular)
+    return heat_markers, graph, snippet_start_in_ms
+
+class SnippetBatch():
+    '''
+    Offline precomputation of snippets for whole catalogues. Fetching runs on the event loop while
+    parsing the watch pages, building the heatmaps and choosing the windows runs in a pool of
+    processes, so throughput scales with the number of cores instead of being bound by the GIL.
+    The results are written as a SongCatalogue.
+    '''
+    from src.utils import PrintLogger
+
+    def __init__(
+                    self,
+                    window_size_in_sec = 15,
+                    no_of_processes = None,
+                    max_concurrency = 8,
+                    dump_info = PrintLogger.register('SnippetBatch')):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.window_size_in_sec = window_size_in_sec
+        self.max_concurrency = max_concurrency
+        self.dump_info = dump_info
+
+        # None: one process per core
+        self.pool = ProcessPoolExecutor(max_workers = no_of_processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.pool.shutdown()
+        if exc_type:
+            print(exc_type, exc_value, exc_traceback)
+
+    async def score(self, page, total_duration_in_ms = None):
+        from asyncio import get_running_loop as asyncio_get_running_loop
+
+        return await asyncio_get_running_loop().run_in_executor(
+                        self.pool, score_page, page, total_duration_in_ms, self.window_size_in_sec)
+
+    async def run_bounded(self, job, args_list):
+        # awaits job(*args) for every args; at most max_concurrency jobs fetch or wait for the
+        # pool at once. Failed and empty jobs are left out, jobs hitting an open circuit are
+        # repeated once it is due to close
+        from asyncio import Semaphore as asyncio_Semaphore
+        from asyncio import gather as asyncio_gather
+        from asyncio import sleep as asyncio_sleep
+        from src.RetryHandler import CircuitOpenError
+
+        semaphore = asyncio_Semaphore(self.max_concurrency)
+        async def bounded(args):
+            while True:
+                async with semaphore:
+                    try:
+                        return await job(*args)
+                    except CircuitOpenError as coe:
+                        retry_after_in_sec = coe.retry_after_in_sec
+                    except Exception as e:
+                        self.dump_info().log(f'Skipping job: {e}', important = True)
+                        return None
+                # the slot is free for jobs that need no youtube request while waiting
+                await asyncio_sleep(retry_after_in_sec)
+
+        return [song for song in await asyncio_gather(*[bounded(args) for args in args_list]) if song]
+
+    async def run_pages(self, page_dir):
+        '''
+        Scores saved watch pages; the file name without extension is taken as the youtube id.
+        Without spotify data the heatmaps stay in video time.
+        '''
+        import os
+        from glob import glob
+        from asyncio import to_thread as asyncio_to_thread
+        from src.MedleyGenerator import Song
+
+        def read(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        async def score_file(path):
+            result = await self.score(await asyncio_to_thread(read, path))
+            if not result:
+                return None
+
+            (time_start_in_ms, duration_in_ms, _), graph, snippet_start_in_ms = result
+            yt_vid_id = os.path.splitext(os.path.basename(path))[0]
+            duration = int(time_start_in_ms[-1] + duration_in_ms[-1])
+            return Song(yt_vid_id, yt_vid_id, '', duration, 0, yt_vid_id, yt_vid_id, graph, snippet_start_in_ms)
+
+        paths = sorted(glob(os.path.join(page_dir, '*.htm*')))
+        with self.dump_info(f'Scoring {len(paths)} pages from {page_dir}'):
+            return await self.run_bounded(score_file, [(path,) for path in paths])
+
+    async def run_playlists(self, pl_uris, sp_handler, yt_handler):
+        # yt_handler: an AsyncYTHandler; its heatmap cache is used and filled
+        from src.MedleyGenerator import Song
+
+        async def read_page(response):
+            try:
+                return await response.read()
+            finally:
+                response.release()
+
+        async def score_track(uri, name, artists, duration, popularity):
+            yt_vid_id, yt_vid_name = await yt_handler.search_async(name, cache_key = uri)
+            if not yt_vid_id:
+                return None
+
+            page = yt_handler.heatmap_cache.get(yt_vid_id) if yt_handler.heatmap_cache else None
+            if page is None:
+                # reading the page is part of the retried attempt
+                page = await yt_handler.get(f'https://www.youtube.com/watch?v={yt_vid_id}', read = read_page)
+
+            result = await self.score(page, duration)
+            if not result:
+                return None
+
+            heat_markers, graph, snippet_start_in_ms = result
+            if yt_handler.heatmap_cache:
+                yt_handler.heatmap_cache.put(yt_vid_id, heat_markers)
+            return Song(uri, name, artists, duration, popularity, yt_vid_id, yt_vid_name, graph, snippet_start_in_ms)
+
+        # tracks on several playlists are scored once
+        tracks = {}
+        for pl_uri in pl_uris:
+            with self.dump_info(f'Retrieving tracks of {pl_uri}'):
+                async for _, batch in sp_handler.iter_playlist_pages(pl_uri):
+                    for track in batch:
+                        tracks.setdefault(track[0], track)
+
+        with self.dump_info(f'Scoring {len(tracks)} tracks'):
+            return await self.run_bounded(score_track, tracks.values())
+
+    def save(self, out_path, songs):
+        from src.SongCatalogue import SongCatalogue
+
+        SongCatalogue.save(out_path, songs)
+        self.dump_info().log(f'Saved {len(songs)} songs to {out_path}.')
@@ -0,0 +1,252 @@
+class SnippetCatalogue():
+    '''
+    Precomputed snippets per spotify track in a SQLite table: youtube id and name, the heatmap and
+    the best snippet start for each of window_sizes_in_sec. It is filled ahead of time by a
+    SnippetIndexer (or MG_batch.py) and by every live resolution of the MedleyGenerator, so a medley
+    over catalogued tracks needs no request to youtube at all.
+    Unlike a SongCatalogue, which is written once, entries are added and replaced one at a time.
+    '''
+    from src.utils import PrintLogger
+
+    WINDOW_SIZES_IN_SEC = (10, 15, 30)
+    # sqlite allows at most 999 parameters per statement
+    MAX_VARIABLES = 900
+
+    def __init__(
+                    self,
+                    cache_file_path = 'SNIPPET_CATALOGUE.sqlite',
+                    window_sizes_in_sec = WINDOW_SIZES_IN_SEC,
+                    dump_info = PrintLogger.register('SnippetCatalogue')):
+        import sqlite3
+        from threading import Lock
+
+        self.path = cache_file_path
+        self.window_sizes_in_sec = tuple(window_sizes_in_sec)
+        self.dump_info = dump_info
+
+        self.lock = Lock()
+        self.con = sqlite3.connect(self.path, check_same_thread = False)
+        with self.lock, self.con:
+            self.con.execute('''CREATE TABLE IF NOT EXISTS snippets (
+                                    uri TEXT PRIMARY KEY,
+                                    yt_id TEXT NOT NULL,
+                                    yt_name TEXT NOT NULL,
+                                    duration INTEGER NOT NULL,
+                                    heat_x BLOB NOT NULL,
+                                    heat_y BLOB NOT NULL,
+                                    is_regular INTEGER NOT NULL,
+                                    snippet_starts TEXT NOT NULL,
+                                    indexed REAL NOT NULL)''')
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        if exc_type:
+            print(exc_type, exc_value, exc_traceback)
+
+    def close(self):
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    def __len__(self):
+        with self.lock:
+            return self.con.execute('SELECT COUNT(*) FROM snippets').fetchone()[0]
+
+    def __contains__(self, uri):
+        return not self.find_missing([uri])
+
+    def get_snippet_starts(self, graphs):
+        # graphs of the same kind and length are scored together
+        from src.popularity import find_best_windows_for_graphs
+
+        snippet_starts = find_best_windows_for_graphs(
+                            graphs,
+                            [size * 1000 for size in self.window_sizes_in_sec])
+        return [dict(zip(self.window_sizes_in_sec, starts)) for starts in snippet_starts]
+
+    def put(self, song):
+        self.put_many([song])
+
+    def put_many(self, songs):
+        import json
+        from time import time
+
+        # starts resolved along with the song are stored as they are; only the others are scored
+        songs = list(songs)
+        snippet_starts = [
+            {size: song.snippet_starts[size] for size in self.window_sizes_in_sec}
+            if set(self.window_sizes_in_sec) <= set(song.snippet_starts) else None
+            for song in songs]
+        unscored = [i for i, starts in enumerate(snippet_starts) if starts is None]
+        for i, starts in zip(unscored, self.get_snippet_starts([songs[i].graph for i in unscored])):
+            snippet_starts[i] = starts
+
+        now = time()
+        rows = []
+        for song, starts in zip(songs, snippet_starts):
+            rows.append((
+                            song.uri,
+                            song.yt_id,
+                            song.yt_name,
+                            int(song.duration),
+                            song.graph.x.tobytes(),
+                            song.graph.y.tobytes(),
+                            song.graph.is_regular,
+                            json.dumps(starts),
+                            now))
+        if not rows:
+            return
+
+        with self.lock, self.con:
+            self.con.executemany('INSERT OR REPLACE INTO snippets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def select(self, columns, uris):
+        # yields the rows of all catalogued uris, a chunk of uris per query
+        uris = list(dict.fromkeys(uris))
+        for i in range(0, len(uris), self.MAX_VARIABLES):
+            chunk = uris[i:i + self.MAX_VARIABLES]
+            placeholders = ', '.join('?' * len(chunk))
+            with self.lock:
+                rows = self.con.execute(
+                                f'SELECT {columns} FROM snippets WHERE uri IN ({placeholders})',
+                                chunk).fetchall()
+            yield from rows
+
+    def find_missing(self, uris):
+        uris = set(uris)
+        return uris - {uri for (uri,) in self.select('uri', uris)}
+
+    def get_many(self, tracks, snippet_duration_in_sec):
+        '''
+        tracks: a TrackBatch or (uri, name, artists, duration, popularity) tuples.
+        Returns {uri: Song} for every catalogued track; name, artists and popularity are the current
+        ones from spotify. Window sizes that were not precomputed are scored from the stored heatmap.
+        '''
+        import json
+        import numpy as np
+        from src.MedleyGenerator import Song
+        from src.popularity import Heatmap
+
+        tracks = {track[0]: track for track in tracks}
+        songs = {}
+        for uri, yt_id, yt_name, heat_x, heat_y, is_regular, snippet_starts in self.select(
+                        'uri, yt_id, yt_name, heat_x, heat_y, is_regular, snippet_starts', tracks):
+            graph = Heatmap(np.frombuffer(heat_x, dtype = np.float32), np.frombuffer(heat_y, dtype = np.float32), is_regular)
+
+            # json turns the window sizes into strings
+            snippet_starts = {int(size): start for size, start in json.loads(snippet_starts).items()}
+
+            _, name, artists, duration, popularity = tracks[uri]
+            song = Song(uri, name, artists, duration, popularity, yt_id, yt_name, graph, None, snippet_starts = snippet_starts)
+            song.snippet_start_in_ms = song.get_snippet_start(snippet_duration_in_sec)
+            songs[uri] = song
+        return songs
+
+    def get(self, track, snippet_duration_in_sec):
+        return self.get_many([track], snippet_duration_in_sec).get(track[0])
+
+class SnippetIndexer():
+    '''
+    Background task filling a SnippetCatalogue from popular playlists. Tracks that are not yet
+    catalogued are resolved by resolve, a coroutine function taking (uri, name, artists, duration,
+    popularity) and returning a Song or None, no_of_workers at a time. A round over all playlists
+    is repeated every refresh_interval_in_sec to pick up new entries.
+    Without pl_uris the playlists are the top results of searching spotify for queries.
+    '''
+    from src.utils import PrintLogger
+
+    POPULAR_QUERIES = ('Top 50 Global', 'Today\'s Top Hits', 'Hot Hits')
+
+    def __init__(
+                    self,
+                    catalogue,
+                    sp_handler,
+                    resolve,
+                    pl_uris = None,
+                    queries = POPULAR_QUERIES,
+                    no_of_workers = 2,
+                    refresh_interval_in_sec = 24 * 3600,
+                    dump_info = PrintLogger.register('SnippetIndexer')):
+
+        self.catalogue = catalogue
+        self.sp_handler = sp_handler
+        self.resolve = resolve
+        self.pl_uris = pl_uris
+        self.queries = queries
+        self.no_of_workers = no_of_workers
+        self.refresh_interval_in_sec = refresh_interval_in_sec
+        self.dump_info = dump_info
+
+        self.index_task = None
+
+    def start(self):
+        # needs a running event loop
+        from asyncio import create_task as asyncio_create_task
+
+        if (not self.index_task) or self.index_task.done():
+            self.index_task = asyncio_create_task(self.keep_indexing())
+
+    def stop(self):
+        if self.index_task:
+            self.index_task.cancel()
+
+    async def get_playlists(self):
+        if self.pl_uris:
+            return list(self.pl_uris)
+
+        pl_uris = []
+        for query in self.queries:
+            pl_uris += (await self.sp_handler.search_playlist_async(query))[0]
+        return list(dict.fromkeys(pl_uris))
+
+    async def index_playlist(self, pl_uri):
+        from asyncio import Semaphore as asyncio_Semaphore
+        from asyncio import gather as asyncio_gather
+        from asyncio import sleep as asyncio_sleep
+        from asyncio import to_thread as asyncio_to_thread
+        from src.RetryHandler import CircuitOpenError
+
+        semaphore = asyncio_Semaphore(self.no_of_workers)
+        async def index_track(track):
+            while True:
+                async with semaphore:
+                    try:
+                        song = await self.resolve(*track)
+                        break
+                    except CircuitOpenError as coe:
+                        retry_after_in_sec = coe.retry_after_in_sec
+                    except Exception as e:
+                        self.dump_info().log(f'Skipping "{track[1]}": {e}', important = True)
+                        return 0
+                # youtube is unreachable for now, not this track: try again after the breaker's trial
+                await asyncio_sleep(retry_after_in_sec)
+            if not song:
+                return 0
+            await asyncio_to_thread(self.catalogue.put, song)
+            return 1
+
+        added = 0
+        async for _, batch in self.sp_handler.iter_playlist_pages(pl_uri):
+            missing = self.catalogue.find_missing(batch.uri)
+            tracks = {track[0]: track for track in batch if track[0] in missing}
+            added += sum(await asyncio_gather(*[index_track(track) for track in tracks.values()]))
+        return added
+
+    async def index(self):
+        for pl_uri in await self.get_playlists():
+            with self.dump_info(f'Indexing {pl_uri}'):
+                try:
+                    added = await self.index_playlist(pl_uri)
+                    self.dump_info().log(f'Added {added} songs to the catalogue.')
+                except Exception as e:
+                    self.dump_info().log(f'Indexing {pl_uri} failed: {e}', important = True)
+
+    async def keep_indexing(self):
+        from asyncio import sleep as asyncio_sleep
+
+        while True:
+            try:
+                await self.index()
+            except Exception as e:
+                self.dump_info().log(f'Indexing failed: {e}', important = True)
+            await asyncio_sleep(self.refresh_interval_in_sec)
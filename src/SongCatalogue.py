@@ -0,0 +1,121 @@
+class SongCatalogue():
+    '''
+    Resolved songs stored column-wise as a directory of .npy files so that a whole catalogue can be
+    memory-mapped: opening it only maps the files, nothing is parsed per song. Songs are built on
+    indexing, their heatmaps being views into the mapped arrays.
+
+    records.npy         one structured record per song (duration, popularity, snippet start,
+                        is_regular, offset of its heatmap)
+    text.npy            all strings utf-8 encoded back to back
+    text_offsets.npy    start of every string in text.npy; string j of song i is number i * 5 + j
+                        of uri, name, artists, yt_id, yt_name
+    heat_x.npy          all heatmaps back to back as float32; heat_y.npy alike
+    '''
+    from src.utils import PrintLogger
+
+    TEXT_COLUMNS = ('uri', 'name', 'artists', 'yt_id', 'yt_name')
+    RECORD_DTYPE = [
+                    ('duration', 'i4'),
+                    ('popularity', 'i1'),
+                    ('snippet_start_in_ms', 'i4'),
+                    ('is_regular', '?'),
+                    ('heat_offset', 'i8')]
+
+    def __init__(self, path, mmap_mode = 'r', dump_info = PrintLogger.register('SongCatalogue')):
+        import os
+        import numpy as np
+
+        self.path = path
+        self.dump_info = dump_info
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode)
+
+        self.records = load('records')
+        self.text = load('text')
+        self.text_offsets = load('text_offsets')
+        self.heat_x = load('heat_x')
+        self.heat_y = load('heat_y')
+
+        # uri -> row; only built when songs are looked up by uri
+        self.rows = None
+
+    @classmethod
+    def save(cls, path, songs):
+        import os
+        import numpy as np
+
+        songs = list(songs)
+        os.makedirs(path, exist_ok = True)
+
+        records = np.zeros(len(songs), dtype = cls.RECORD_DTYPE)
+        encoded = []
+        heat_x = []
+        heat_y = []
+        heat_offset = 0
+        for i, song in enumerate(songs):
+            records[i] = (
+                            song.duration,
+                            song.popularity,
+                            song.snippet_start_in_ms,
+                            song.graph.is_regular,
+                            heat_offset)
+            heat_offset += len(song.graph)
+            heat_x.append(song.graph.x)
+            heat_y.append(song.graph.y)
+            encoded += [str(getattr(song, column)).encode() for column in cls.TEXT_COLUMNS]
+
+        text_offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+        np.cumsum([len(text) for text in encoded], out = text_offsets[1:])
+
+        def store(name, array):
+            np.save(os.path.join(path, name + '.npy'), array)
+
+        store('records', records)
+        store('text', np.frombuffer(b''.join(encoded), dtype = np.uint8))
+        store('text_offsets', text_offsets)
+        store('heat_x', np.concatenate(heat_x or [[]]).astype(np.float32))
+        store('heat_y', np.concatenate(heat_y or [[]]).astype(np.float32))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def get_text(self, row, column):
+        i = row * len(self.TEXT_COLUMNS) + self.TEXT_COLUMNS.index(column)
+        return self.text[self.text_offsets[i]:self.text_offsets[i + 1]].tobytes().decode()
+
+    def __getitem__(self, row):
+        from src.MedleyGenerator import Song
+        from src.popularity import Heatmap
+
+        if row < 0:
+            row += len(self)
+        record = self.records[row]
+        heat_start = record['heat_offset']
+        heat_end = self.records[row + 1]['heat_offset'] if row + 1 < len(self) else len(self.heat_y)
+
+        # float32 views into the mapped files: no copy
+        graph = Heatmap(self.heat_x[heat_start:heat_end], self.heat_y[heat_start:heat_end], record['is_regular'])
+        return Song(
+                    self.get_text(row, 'uri'),
+                    self.get_text(row, 'name'),
+                    self.get_text(row, 'artists'),
+                    int(record['duration']),
+                    int(record['popularity']),
+                    self.get_text(row, 'yt_id'),
+                    self.get_text(row, 'yt_name'),
+                    graph,
+                    int(record['snippet_start_in_ms']))
+
+    def find(self, uri):
+        if self.rows is None:
+            self.rows = {self.get_text(row, 'uri'): row for row in range(len(self))}
+
+        row = self.rows.get(uri)
+        if row is None:
+            return None
+        return self[row]
@@ -0,0 +1,57 @@
+class SongScheduler():
+    '''
+    Play order of a medley. Songs are pushed as they get resolved and popped in the order of the
+    policy from a heap, so choosing the next song is O(log n) however many songs are waiting.
+    Every uri is handed out at most once.
+
+    policy is one of
+        'playlist'      position in the playlist; songs without a position come last, in arrival order
+        'popularity'    most popular on spotify first
+        'shuffle'       random order without repeats
+    or a function that maps a song to a sort key (smallest first).
+    '''
+
+    def __init__(self, policy = 'playlist', seed = None):
+        from random import Random
+
+        self.random = Random(seed)
+        self.policies = {
+            'playlist': lambda song: song.position if song.position is not None else float('inf'),
+            'popularity': lambda song: -song.popularity,
+            # a random key per song drawn on arrival amounts to a shuffle of everything present
+            'shuffle': lambda song: self.random.random()}
+
+        if callable(policy):
+            self.key = policy
+        elif policy in self.policies:
+            self.key = self.policies[policy]
+        else:
+            raise ValueError(f'Unknown scheduling policy {policy}; choose one of {list(self.policies)} or pass a function.')
+
+        self.heap = []
+        self.seen = set()
+        # ties keep the order of arrival and songs themselves are never compared
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, song):
+        from heapq import heappush
+
+        if song.uri in self.seen:
+            return False
+        self.seen.add(song.uri)
+        heappush(self.heap, (self.key(song), self.counter, song))
+        self.counter += 1
+        return True
+
+    def pop(self):
+        from heapq import heappop
+
+        if not self.heap:
+            return None
+        return heappop(self.heap)[-1]
+
+    def peek(self):
+        return self.heap[0][-1] if self.heap else None
@@ -7,15 +7,85 @@ class SpotifyHandler():
                     _async_handler, 
                     env_file_path, 
                     dump_info = PrintLogger.register('SpotifyHandler'),
-                    playable = False
+                    playable = False,
+                    max_workers = 4,
+                    min_request_interval_in_sec = 0.05,
+                    max_rate_limit_retries = 3,
+                    token_cache_path = '.cache_spotify',
+                    bulk_cache_size = 20000,
+                    response_cache_path = None,
+                    response_cache_size = 1000
     ):
-        self.sp = self.setup_spotify_connection(env_file_path, playable)
-        self.token = None
-        self.token_timestamp = None
+        from concurrent.futures import ThreadPoolExecutor
+        
+        # one pooled session for all calls; spotipy is synchronous, so async callers run it on a
+        # bounded pool of threads instead of blocking the event loop
+        self.session = self.create_session(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'spotify')
+        
         self.ash = _async_handler
         self.dump_info = dump_info
         
-    def setup_spotify_connection(self, env_file_path, playable):
+        self.token_manager = None
+        self.sp = self.setup_spotify_connection(env_file_path, playable, token_cache_path)
+        
+        # requests are spaced by min_request_interval_in_sec; a 429 blocks everybody for Retry-After
+        from src.RetryHandler import RateLimiter
+        self.rate_limiter = RateLimiter(min_request_interval_in_sec)
+        self.max_rate_limit_retries = max_rate_limit_retries
+        
+        self.devices = DeviceRegistry(self)
+        
+        # items of the multi id endpoints by endpoint, id and arguments; see retrieve_bulk
+        from src.CacheHandler import CacheHandler
+        self.bulk_cache = CacheHandler(None, memory_size = bulk_cache_size)
+        self.bulk_pending = {}
+        
+        # name -> bound spotipy method; responses per endpoint, see RESPONSE_CACHE_TTLS
+        self.methods = {}
+        self.response_caches = {
+            endpoint: CacheHandler(
+                        response_cache_path, 
+                        table = endpoint, 
+                        ttl_in_sec = ttl_in_sec, 
+                        memory_size = response_cache_size)
+            for endpoint, ttl_in_sec in self.RESPONSE_CACHE_TTLS.items()}
+        
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.dump_info().log('Exiting SpotifyHandler')
+        if self.token_manager:
+            self.token_manager.stop()
+        self.executor.shutdown(wait = False)
+        self.session.close()
+        for cache in self.response_caches.values():
+            cache.close()
+        if exc_type:
+            print(exc_type, exc_value, exc_traceback)
+            
+    def create_session(self, pool_size):
+        import requests
+        from urllib3.util.retry import Retry
+        
+        # retries connection errors and server errors; 429 is left to retrieve(_async), which
+        # waits for as long as Spotify asks to
+        retry = Retry(
+                    total = 3,
+                    read = False,
+                    allowed_methods = frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                    status = 3,
+                    backoff_factor = 0.3,
+                    status_forcelist = (500, 502, 503, 504))
+        adapter = requests.adapters.HTTPAdapter(
+                    pool_connections = pool_size, 
+                    pool_maxsize = pool_size, 
+                    max_retries = retry)
+        
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+        
+    def setup_spotify_connection(self, env_file_path, playable, token_cache_path = None):
         from src.utils import install_pip_pkg
         install_pip_pkg({'spotipy'})
 
@@ -32,6 +102,7 @@ class SpotifyHandler():
         sp = None
         if playable:
             from spotipy.oauth2 import SpotifyOAuth
+            from spotipy.cache_handler import CacheFileHandler
             
             # scope explanation 
             # https://developer.spotify.com/documentation/general/guides/authorization/scopes/
@@ -46,9 +117,14 @@ class SpotifyHandler():
                             redirect_uri=self.redirect_url,
                             scope=scope,
                             #show_dialog = True,
-                            open_browser = True)
+                            open_browser = True,
+                            # restarts reuse the token on disk instead of going through OAuth again
+                            cache_handler = CacheFileHandler(cache_path = token_cache_path))
             
-            sp = spotipy.Spotify(auth_manager=self.client_credentials)
+            # spotipy asks the token manager for a token on every request: a token in memory that
+            # is refreshed in the background instead of a refresh on the request path
+            self.token_manager = TokenManager(self.client_credentials, dump_info = self.dump_info)
+            sp = spotipy.Spotify(auth_manager=self.token_manager, requests_session=self.session)
             
         else:
             from spotipy.oauth2 import SpotifyClientCredentials
@@ -56,59 +132,33 @@ class SpotifyHandler():
                             client_id = self.client_id, 
                             client_secret = client_keys['client_secret'])
             sp = spotipy.Spotify(client_credentials_manager=self.client_credentials,
-                             backoff_factor = 3, 
-                             retries=3 )
+                             requests_session=self.session)
         
         return sp
     
     def get_connection(self):
         return self.sp
     
-    def get_token(self, *args, **kwargs):
-        from datetime import datetime as dt 
-        from datetime import timedelta
-        
-        if not self.token:
-            response = self.client_credentials.get_access_token(*args, **kwargs)
-            self.token = response['access_token']
-            self.token_expires = dt.now() + timedelta(seconds = response['expires_in'])
-            self.refresh_token = response['refresh_token']
-        
-        if self.token_expires <= dt.now():
-            response = self.client_credentials.refresh_access_token(self.refresh_token)
-            self.token = response['access_token']
-            self.token_expires = dt.fromtimestamp(response['expires_at'])
-            self.refresh_token = response['refresh_token']
-            
-        return self.token
+    def get_token(self):
+        if self.token_manager:
+            return self.token_manager.get_token()
+        # client credentials: spotipy caches and renews the token itself
+        return self.client_credentials.get_access_token(as_dict = False)
+    
+    def start_token_refresh(self):
+        # needs a running event loop
+        if self.token_manager:
+            self.token_manager.start()
     
     def get_device_id(self, for_name, wait = False):
-        devices_dict = None
-        from requests import ConnectionError
-        
-        while not devices_dict:
-            try:
-                devices_dict = self.sp.devices()['devices']
-            except ConnectionError as ce:
-                devices_dict = None
-                self.dump_info().log('ConnectionError: waiting endlessly.', important = True)
-                from time import sleep
-                sleep(3)
-        
-        device_id = next((item['id'] for item in devices_dict if item['name'] == for_name), None)
-        if wait and (not device_id):
-            from time import sleep
-            
-            while (wait and (not device_id)):
-                
-                # handle reloading of embed
-                self.dump_info().log('waiting in endless loop: handle reloading of embed', important = True)
-                
-                sleep(1)
-                devices_dict = self.sp.devices()['devices']
-                device_id = next((item['id'] for item in devices_dict if item['name'] == for_name), None)
-        
-        return device_id
+        return self.devices.get_device_id(for_name, wait)
+    
+    async def get_device_id_async(self, for_name, wait = False):
+        return await self.devices.get_device_id_async(for_name, wait)
+    
+    def is_device_error(self, error):
+        # the device is gone (i.e. the embed was reloaded) or was never active
+        return (error.http_status == 404) or (error.reason == 'NO_ACTIVE_DEVICE')
     
     from enum import Enum
     class PlaybackStatus(Enum):
@@ -119,7 +169,12 @@ class SpotifyHandler():
         OTHER = -1
             
     def is_playing(self, device_id):
-        status = self.sp.current_playback()
+        return self.get_playback_status(self.sp.current_playback(), device_id)
+    
+    async def is_playing_async(self, device_id):
+        return self.get_playback_status(await self.retrieve_async('current_playback'), device_id)
+        
+    def get_playback_status(self, status, device_id):
         if status['device']['id'] != device_id :
             return self.PlaybackStatus.DIFFERENT_DEVICE
         elif status['is_playing']:
@@ -137,31 +192,71 @@ class SpotifyHandler():
             self.dump_info().log({se}, important = True)
             
             # handle reloading of embed
-            self.dump_info().log('handle reloading of embed', important = True)
+            if self.is_device_error(se):
+                self.devices.invalidate(kwargs.get('device_id', args[0] if args else None))
+            
+    async def play_async(self, *args, **kwargs):
+        from spotipy import SpotifyException
+        try:
+            await self.retrieve_async('start_playback', *args, **kwargs)
+        except SpotifyException as se:
+            self.dump_info().log({se}, important = True)
+            
+            # handle reloading of embed
+            if self.is_device_error(se):
+                self.devices.invalidate(kwargs.get('device_id', args[0] if args else None))
+                
+    async def play_on_device_async(self, device_name, **kwargs):
+        # looks the device up in the registry; if it is gone the embed was probably reloaded and
+        # playing is tried once more on the device that took its name
+        from spotipy import SpotifyException
+        
+        for is_retry in (False, True):
+            device_id = await self.get_device_id_async(device_name, wait = True)
+            try:
+                return await self.retrieve_async('start_playback', device_id = device_id, **kwargs)
+            except SpotifyException as se:
+                if (not self.is_device_error(se)) or is_retry:
+                    self.dump_info().log({se}, important = True)
+                    return None
+                self.dump_info().log(f'Device {device_name} is gone; looking it up again.')
+                self.devices.invalidate(device_id)
             
     def toggle_play(self, device_id):
-        res = self.is_playing(device_id)
-        if (res == self.PlaybackStatus.PLAYING) or (res == self.PlaybackStatus.PAUSED):
-            if res == self.PlaybackStatus.PLAYING:
-                self.sp.pause_playback(device_id = device_id)
-                return self.PlaybackStatus.PAUSED
-            elif res == self.PlaybackStatus.PAUSED:
-                self.sp.start_playback(device_id = device_id)
-                return self.PlaybackStatus.PLAYING
-            elif res == self.PlaybackStatus.STOPPED:
-                return self.PlaybackStatus.STOPPED
+        from spotipy import SpotifyException
+        
+        try:
+            res = self.is_playing(device_id)
+            if (res == self.PlaybackStatus.PLAYING) or (res == self.PlaybackStatus.PAUSED):
+                if res == self.PlaybackStatus.PLAYING:
+                    self.sp.pause_playback(device_id = device_id)
+                    return self.PlaybackStatus.PAUSED
+                elif res == self.PlaybackStatus.PAUSED:
+                    self.sp.start_playback(device_id = device_id)
+                    return self.PlaybackStatus.PLAYING
+                elif res == self.PlaybackStatus.STOPPED:
+                    return self.PlaybackStatus.STOPPED
+        except SpotifyException as se:
+            if not self.is_device_error(se):
+                raise
+            self.devices.invalidate(device_id)
         return self.PlaybackStatus.OTHER
         
     def search_playlist(self, query, **kwargs):
         kwargs.update({'q' : query, 'limit' : 10, 'type' : 'playlist'})
-        res = self.retrieve('search', **kwargs)
-
+        return self.parse_playlists(self.retrieve('search', **kwargs), kwargs['limit'])
+    
+    async def search_playlist_async(self, query, **kwargs):
+        kwargs.update({'q' : query, 'limit' : 10, 'type' : 'playlist'})
+        return self.parse_playlists(await self.retrieve_async('search', **kwargs), kwargs['limit'])
+    
+    def parse_playlists(self, res, limit):
         pl_uri = []
         pl_names = []
         pl_image_url = []
         pl_track_total = []
         res = res['playlists']['items']
-        for pl_number in range(min(kwargs['limit'], len(res))):
+        for pl_number in range(min(limit, len(res))):
             pl_uri.append(res[pl_number]['uri'])
             pl_names.append(res[pl_number]['name'])
             pl_track_total.append(res[pl_number]['tracks']['total'])
@@ -169,48 +264,94 @@ class SpotifyHandler():
         
         return pl_uri, pl_names, pl_image_url, pl_track_total      
     
-    def get_playlist_tracks(self, pl_uri):
-        res = self.retrieve('playlist', pl_uri)
-        track_uri = []
-        track_names = []
-        track_popularity = []
-        track_artists = []
-        track_duration = []
-        for track_number in range(len(res)):
-            track = res['tracks']['items'][track_number]['track']
-            track_uri.append(track['uri'])
-            track_names.append(track['name'])
-            track_popularity.append(track['popularity'])
-            track_duration.append(track['duration_ms'])
-
-            artist_len = len(track['artists'])
-            artists = []
-            for artist_number in range(artist_len):
-                artists.append(track['artists'][artist_number]['name'])
-            track_artists.append(', '.join(artists))
+    # only what a medley needs of every playlist item
+    PLAYLIST_ITEM_FIELDS = 'items(track(uri,name,artists(name),duration_ms,popularity)),total'
+    
+    def get_playlist_page(self, pl_uri, offset, limit = 100):
+        return self.retrieve('playlist_items', pl_uri, **self.get_playlist_page_kwargs(offset, limit))
+    
+    async def get_playlist_page_async(self, pl_uri, offset, limit = 100):
+        return await self.retrieve_async('playlist_items', pl_uri, **self.get_playlist_page_kwargs(offset, limit))
+        
+    def get_playlist_page_kwargs(self, offset, limit):
+        return {
+            'fields': self.PLAYLIST_ITEM_FIELDS, 
+            'limit': limit, 
+            'offset': offset,
+            'additional_types': ('track',)}
+    
+    def parse_playlist_items(self, items):
+        from src.TrackBatch import TrackBatch
+        
+        tracks = []
+        for item in items:
+            track = item['track']
+            # removed tracks and local files come without track or uri
+            if (not track) or (not track['uri']):
+                continue
+                
+            tracks.append((
+                    track['uri'],
+                    track['name'],
+                    ', '.join([artist['name'] for artist in track['artists']]),
+                    track['duration_ms'],
+                    track['popularity']))
         # possibly track->album->{id (to get genre), name, release_date, images}
+        return TrackBatch.from_tracks(tracks)
+    
+    def get_playlist_tracks(self, pl_uri, page_size = 100):
+        from src.TrackBatch import TrackBatch
         
-        return track_uri, track_names, track_artists, track_duration, track_popularity
+        res = self.get_playlist_page(pl_uri, 0, page_size)
+        pages = [self.parse_playlist_items(res['items'])]
+        for offset in range(page_size, res['total'], page_size):
+            pages.append(self.parse_playlist_items(self.get_playlist_page(pl_uri, offset, page_size)['items']))
+        
+        return TrackBatch.concat(pages)
+    
+    async def iter_playlist_pages(self, pl_uri, page_size = 100, max_tracks = None):
+        '''
+        Yields (offset, TrackBatch) per page as soon as the page has arrived. Once the first page
+        tells the total, the remaining pages are fetched concurrently (as many at once as the
+        executor has threads), so later pages can come in out of playlist order.
+        With max_tracks only the pages holding the first max_tracks are fetched.
+        '''
+        from asyncio import as_completed as asyncio_as_completed
+        
+        res = await self.get_playlist_page_async(pl_uri, 0, page_size)
+        yield 0, self.parse_playlist_items(res['items'])
+        
+        total = min(res['total'], max_tracks) if max_tracks else res['total']
+        async def get_page(offset):
+            return offset, await self.get_playlist_page_async(pl_uri, offset, page_size)
+        
+        pages = [get_page(offset) for offset in range(page_size, total, page_size)]
+        for page in asyncio_as_completed(pages):
+            offset, res = await page
+            yield offset, self.parse_playlist_items(res['items'])
         
     def retrieve_tracks(self, cluster_song_id_list):   
-        # regarding ids : a list of spotify URIs, URLs or IDs. Maximum: 50 IDs.
+        # regarding ids : a list of spotify URIs, URLs or IDs
         # install flatdict
         from src.utils import install_pip_pkg
         install_pip_pkg({'flatdict'})
         
         from flatdict import FlatterDict as flatten
         from pandas import json_normalize as pd_json_normalize
-        song_list = self.retrieve_bits_for_tracks(cluster_song_id_list, 'tracks', market=None)
-        df_songs = pd_json_normalize([dict(flatten(i)) for i in song_list[0]['tracks']])
+        song_list = self.retrieve_bulk('tracks', cluster_song_id_list, market=None)
+        df_songs = pd_json_normalize([dict(flatten(i)) for i in song_list if i])
         return df_songs
     
     def retrieve_artists_from_songs(self, cluster_song_id_list, return_all = 'no'):  
-        # regarding ids : a list of spotify URIs, URLs or IDs. Maximum: 50 IDs.
+        # regarding ids : a list of spotify URIs, URLs or IDs
+        from pandas import json_normalize as pd_json_normalize
+        
         df_songs = self.retrieve_tracks(cluster_song_id_list)
         srs_artist_ids = df_songs['album:artists:0:id']
         
-        response = self.retrieve(self.sp.artists, srs_artist_ids)            
-        df_artists = pd.json_normalize(response['artists'])
+        # one artist per song; artists of several songs are only fetched once
+        response = self.retrieve_bulk('artists', srs_artist_ids.tolist())            
+        df_artists = pd_json_normalize(response)
         
         if return_all == 'no':
             return df_artists
@@ -227,29 +368,227 @@ class SpotifyHandler():
             return df_songs, df_artists
         
     def retrieve_bits_for_tracks(self, cluster_song_id_list, func, **kwargs):    
-        from spotipy.client import SpotifyException
-        # retrieving tracks
-        # regarding ids : a list of spotify URIs, URLs or IDs. Maximum: 50 IDs.
-        song_list = []
-        id_list_len = len(cluster_song_id_list)
-        step = 50
-        step_list =list(range(0, id_list_len, step)) 
-        remainder = id_list_len % step
-        if remainder != 0:
-            step_list += [remainder]
+        return self.retrieve_bulk(func, cluster_song_id_list, **kwargs)
+    
+    NOT_CACHED = object()
+    
+    # endpoints taking a list of ids -> (max ids per request, key of the list in the response)
+    BULK_ENDPOINTS = {
+        'tracks': (50, 'tracks'),
+        'artists': (50, 'artists'),
+        'albums': (20, 'albums'),
+        'episodes': (50, 'episodes'),
+        'shows': (50, 'shows'),
+        'audio_features': (100, None)}
+    
+    def plan_bulk(self, func, ids, kwargs, skip_pending = True):
+        # splits what is neither cached nor being fetched into chunks the endpoint accepts; cached
+        # items are taken right away since later chunks of the same call may evict them
+        # skip_pending = False also fetches ids a concurrent async call is fetching
+        max_ids, _ = self.BULK_ENDPOINTS[func]
+        keys = [f'{func}:{id}:{sorted(kwargs.items())}' for id in ids]
+        
+        results = {}
+        missing = {}
+        for id, key in zip(ids, keys):
+            if (key in results) or (key in missing) or (skip_pending and (key in self.bulk_pending)):
+                continue
+            item = self.bulk_cache.get(key, self.NOT_CACHED)
+            if item is self.NOT_CACHED:
+                missing[key] = id
+            else:
+                results[key] = item
+                
+        missing_keys = list(missing)
+        chunks = [missing_keys[i:i + max_ids] for i in range(0, len(missing_keys), max_ids)]
+        return keys, results, missing, chunks
+    
+    def store_bulk(self, func, chunk, response):
+        # returns {key: item} of the chunk; the cache only spares later calls the request
+        _, items_key = self.BULK_ENDPOINTS[func]
+        items = response[items_key] if items_key else response
+        # spotify answers in the order of the ids, with null for unknown ones
+        chunk_results = dict(zip(chunk, items))
+        for key, item in chunk_results.items():
+            self.bulk_cache.put(key, item)
+        return chunk_results
+            
+    def retrieve_bulk(self, func, ids, **kwargs):
+        '''
+        Fetches a multi id endpoint (see BULK_ENDPOINTS) for any number of ids: ids are deduplicated,
+        also against earlier calls, and chunks are requested concurrently on the executor.
+        Returns one list of items in the order of ids, None for unknown ids.
+        '''
+        ids = list(ids)
+        # the futures of concurrent async calls cannot be awaited from here; their ids are
+        # requested again instead
+        keys, results, missing, chunks = self.plan_bulk(func, ids, kwargs, skip_pending = False)
+        
+        def fetch(chunk):
+            return self.store_bulk(func, chunk, self.retrieve(func, [missing[key] for key in chunk], **kwargs))
             
-        for lower in step_list:
-            upper = min(id_list_len - lower, 50)
-            response = self.retrieve(func, cluster_song_id_list[lower:lower+upper], **kwargs) 
-            song_list.append(response)
-        return song_list
+        # exceptions of the chunks are raised here
+        for chunk_results in self.executor.map(fetch, chunks):
+            results.update(chunk_results)
+        return [results[key] for key in keys]
+    
+    async def retrieve_bulk_async(self, func, ids, **kwargs):
+        # like retrieve_bulk; ids that a concurrent call is already fetching are waited for
+        from asyncio import shield as asyncio_shield
+        from asyncio import get_running_loop as asyncio_get_running_loop
+        
+        ids = list(ids)
+        keys, results, missing, chunks = self.plan_bulk(func, ids, kwargs)
+        
+        loop = asyncio_get_running_loop()
+        
+        # pending futures resolve to the {key: item} of their chunk
+        waiting = {key: self.bulk_pending[key] for key in keys
+                   if (key in self.bulk_pending) and (key not in missing)}
+        pending = {key: loop.create_future() for key in missing}
+        self.bulk_pending.update(pending)
+        
+        async def fetch(chunk):
+            try:
+                chunk_results = self.store_bulk(func, chunk, await self.retrieve_async(func, [missing[key] for key in chunk], **kwargs))
+            except Exception as e:
+                for key in chunk:
+                    pending[key].set_exception(e)
+                raise
+            for key in chunk:
+                pending[key].set_result(chunk_results)
+            return chunk_results
+        
+        tasks = [loop.create_task(fetch(chunk)) for chunk in chunks]
+        try:
+            # own chunks first so that their errors are raised, then chunks of concurrent calls
+            for chunk_results in await self.ash.gather(*tasks):
+                results.update(chunk_results)
+        finally:
+            # on errors and cancellation as well: no key may stay pending without a fetch behind it
+            for task in tasks:
+                task.cancel()
+            for key, future in pending.items():
+                if self.bulk_pending.get(key) is future:
+                    del self.bulk_pending[key]
+                if not future.done():
+                    future.set_exception(RuntimeError(f'Fetching {key} was aborted.'))
+                    
+        for key, future in waiting.items():
+            # shielded: cancelling this call must not cancel the fetch of another one
+            results[key] = (await asyncio_shield(future))[key]
+        return [results[key] for key in keys]
+    
+    def get_retry_after(self, error):
+        # seconds to wait if Spotify rate limited the request, else None
+        if error.http_status != 429:
+            return None
+        headers = error.headers or {}
+        return float(headers.get('Retry-After', 1))
+    
+    # seconds a response stays cached per endpoint; None caches it forever
+    RESPONSE_CACHE_TTLS = {
+        'audio_analysis': None,
+        'audio_features': None,
+        'track': 24 * 60 * 60,
+        'artist': 24 * 60 * 60,
+        'album': 24 * 60 * 60,
+        'playlist': 60 * 60,
+        'playlist_items': 10 * 60,
+        'search': 60}
+    
+    def get_response_cache(self, func, args, kwargs):
+        # returns the cache and key for a call, or (None, None) if the call is not cached
+        name = func if isinstance(func, str) else getattr(func, '__name__', None)
+        cache = self.response_caches.get(name)
+        if not cache:
+            return None, None
+        
+        # only plain arguments make reliable keys
+        plain = (str, int, float, bool, type(None), tuple)
+        if not all(isinstance(arg, plain) for arg in list(args) + list(kwargs.values())):
+            return None, None
+        return cache, repr((args, sorted(kwargs.items())))
+    
+    def get_cache_stats(self):
+        return {
+            endpoint: {'hits': cache.hits, 'misses': cache.misses} 
+            for endpoint, cache in self.response_caches.items() 
+            if cache.hits or cache.misses}
     
     def retrieve(self, func, *args, **kwargs):
+        # cached responses are shared between callers and must not be modified
         from spotipy.client import SpotifyException
         
-        if isinstance(func, str):
-            func = eval('self.sp.' + func)
-            
+        cache, key = self.get_response_cache(func, args, kwargs)
+        if cache:
+            response = cache.get(key, self.NOT_CACHED)
+            if response is not self.NOT_CACHED:
+                return response
+        
+        for retry in range(self.max_rate_limit_retries + 1):
+            # bulk chunks run on the executor in parallel and are spaced like async calls
+            self.rate_limiter.wait()
+            try:
+                response = self.call(func, *args, **kwargs)
+                if cache:
+                    cache.put(key, response)
+                return response
+            except SpotifyException as se:
+                retry_after = self.get_retry_after(se)
+                if (retry_after is None) or (retry == self.max_rate_limit_retries):
+                    raise
+                self.block_for(retry_after)
+    
+    async def retrieve_async(self, func, *args, **kwargs):
+        from functools import partial
+        from asyncio import get_running_loop as asyncio_get_running_loop
+        from spotipy.client import SpotifyException
+        
+        cache, key = self.get_response_cache(func, args, kwargs)
+        if cache:
+            response = cache.get(key, self.NOT_CACHED)
+            if response is not self.NOT_CACHED:
+                return response
+        
+        for retry in range(self.max_rate_limit_retries + 1):
+            await self.rate_limiter.wait_async()
+            try:
+                response = await asyncio_get_running_loop().run_in_executor(
+                                self.executor, 
+                                partial(self.call, func, *args, **kwargs))
+                if cache:
+                    cache.put(key, response)
+                return response
+            except SpotifyException as se:
+                retry_after = self.get_retry_after(se)
+                if (retry_after is None) or (retry == self.max_rate_limit_retries):
+                    raise
+                self.block_for(retry_after)
+    
+    def block_for(self, retry_after_in_sec):
+        # rate limits apply to the whole app, so every caller waits, not only the limited one
+        from time import monotonic
+        
+        self.dump_info().log(f'Rate limited by Spotify: waiting {retry_after_in_sec:.1f}s.', important = True)
+        self.rate_limiter.block_until(monotonic() + retry_after_in_sec)
+        
+    def get_method(self, func):
+        # endpoint names are resolved once instead of evaluated on every call
+        if not isinstance(func, str):
+            return func
+        
+        if func not in self.methods:
+            method = getattr(self.sp, func, None)
+            if func.startswith('_') or not callable(method):
+                raise AttributeError(f'spotipy has no endpoint {func}.')
+            self.methods[func] = method
+        return self.methods[func]
+    
+    def call(self, func, *args, **kwargs):
+        from spotipy.client import SpotifyException
+        
+        func = self.get_method(func)
         response = None
         try:
             response = func(*args, **kwargs)
@@ -261,4 +600,175 @@ class SpotifyHandler():
                     reason = error.reason,         
                     headers = error.headers)
         return response
-           
\ No newline at end of file
+
+class TokenManager():
+    '''
+    Holds the OAuth token in memory and refreshes it refresh_margin_in_sec before it expires: in
+    the background once start() was called from a running event loop, otherwise on the next
+    get_token. Safe to share between threads (streamlit reruns, the spotify executor).
+    The auth manager's cache handler persists every new token to disk; a valid or refreshable
+    token found there spares the OAuth round trip on restarts.
+    Can be passed to spotipy.Spotify as auth_manager.
+    '''
+    from src.utils import PrintLogger
+    
+    def __init__(
+                    self, 
+                    auth_manager, 
+                    refresh_margin_in_sec = 300, 
+                    retry_delay_in_sec = 30, 
+                    dump_info = PrintLogger.register('TokenManager')):
+        from threading import Lock
+        
+        self.auth_manager = auth_manager
+        self.refresh_margin_in_sec = refresh_margin_in_sec
+        self.retry_delay_in_sec = retry_delay_in_sec
+        self.dump_info = dump_info
+        
+        self.token_info = None
+        self.lock = Lock()
+        self.refresh_task = None
+        
+    def is_expiring(self):
+        from time import time
+        return self.token_info['expires_at'] - time() < self.refresh_margin_in_sec
+    
+    def load(self):
+        import warnings
+        
+        # from disk, refreshed by spotipy if it has expired
+        self.token_info = self.auth_manager.validate_token(self.auth_manager.cache_handler.get_cached_token())
+        if self.token_info:
+            self.dump_info().log('Using cached Spotify token.')
+            return
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=DeprecationWarning)
+            self.token_info = self.auth_manager.get_access_token(as_dict = True, check_cache = False)
+        
+    def refresh(self):
+        with self.lock:
+            if not self.token_info:
+                self.load()
+            elif self.is_expiring():
+                self.dump_info().log('Refreshing Spotify token.')
+                self.token_info = self.auth_manager.refresh_access_token(self.token_info['refresh_token'])
+            return self.token_info['access_token']
+            
+    def get_token(self):
+        # fast path without locking; a token is only swapped as a whole
+        token_info = self.token_info
+        if token_info and not self.is_expiring():
+            return token_info['access_token']
+        return self.refresh()
+    
+    def get_access_token(self, as_dict = False):
+        # interface of spotipy's auth managers
+        self.get_token()
+        return self.token_info if as_dict else self.token_info['access_token']
+    
+    def start(self):
+        from asyncio import create_task as asyncio_create_task
+        
+        if (not self.refresh_task) or self.refresh_task.done():
+            self.refresh_task = asyncio_create_task(self.keep_fresh())
+            
+    def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+    
+    async def keep_fresh(self):
+        from time import time
+        from asyncio import sleep as asyncio_sleep
+        from asyncio import to_thread as asyncio_to_thread
+        
+        while True:
+            try:
+                await asyncio_to_thread(self.refresh)
+                delay = self.token_info['expires_at'] - time() - self.refresh_margin_in_sec
+            except Exception as e:
+                self.dump_info().log(f'Refreshing Spotify token failed: {e}', important = True)
+                delay = self.retry_delay_in_sec
+            await asyncio_sleep(max(delay, 1))
+
+class DeviceRegistry():
+    '''
+    Caches the device ids of the Spotify Connect devices by name, so that playing does not cost
+    a /me/player/devices round trip each time. An entry is only dropped when a playback call
+    fails with a device error; unknown names are looked up again with exponential backoff, and
+    concurrent async callers share one lookup.
+    '''
+    
+    def __init__(self, sp_handler, base_delay_in_sec = 1, max_delay_in_sec = 10):
+        self.sp_handler = sp_handler
+        self.base_delay_in_sec = base_delay_in_sec
+        self.max_delay_in_sec = max_delay_in_sec
+        
+        # device name -> device id
+        self.device_ids = {}
+        self.refresh_task = None
+        
+    def get_delay(self, retry):
+        return min(self.max_delay_in_sec, self.base_delay_in_sec * 2 ** retry)
+        
+    def update(self, devices_dict):
+        self.device_ids = {item['name']: item['id'] for item in devices_dict['devices']}
+        
+    def invalidate(self, device_id = None):
+        # without device_id all devices are looked up again
+        self.device_ids = {
+            name: known_id for name, known_id in self.device_ids.items() 
+            if device_id and (known_id != device_id)}
+        
+    def refresh(self):
+        from requests import ConnectionError
+        try:
+            self.update(self.sp_handler.retrieve('devices'))
+        except ConnectionError as ce:
+            self.sp_handler.dump_info().log(f'ConnectionError while looking up devices: {ce}', important = True)
+            
+    async def refresh_async(self):
+        from requests import ConnectionError
+        try:
+            self.update(await self.sp_handler.retrieve_async('devices'))
+        except ConnectionError as ce:
+            self.sp_handler.dump_info().log(f'ConnectionError while looking up devices: {ce}', important = True)
+        
+    def get_device_id(self, for_name, wait = False):
+        from time import sleep
+        
+        retry = 0
+        while for_name not in self.device_ids:
+            self.refresh()
+            if (for_name in self.device_ids) or (not wait):
+                break
+                
+            # handle reloading of embed
+            delay = self.get_delay(retry)
+            self.sp_handler.dump_info().log(f'Waiting {delay}s for device {for_name}.')
+            sleep(delay)
+            retry += 1
+            
+        return self.device_ids.get(for_name)
+        
+    async def get_device_id_async(self, for_name, wait = False):
+        from asyncio import sleep as asyncio_sleep
+        from asyncio import shield as asyncio_shield
+        from asyncio import ensure_future as asyncio_ensure_future
+        
+        retry = 0
+        while for_name not in self.device_ids:
+            if (not self.refresh_task) or self.refresh_task.done():
+                self.refresh_task = asyncio_ensure_future(self.refresh_async())
+            # shielded: a cancelled caller does not cancel the lookup the others wait for
+            await asyncio_shield(self.refresh_task)
+            if (for_name in self.device_ids) or (not wait):
+                break
+                
+            # handle reloading of embed
+            delay = self.get_delay(retry)
+            self.sp_handler.dump_info().log(f'Waiting {delay}s for device {for_name}.')
+            await asyncio_sleep(delay)
+            retry += 1
+            
+        return self.device_ids.get(for_name)
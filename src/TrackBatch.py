@@ -0,0 +1,121 @@
+class TrackBatch():
+    '''
+    Columnar store for the tracks of one or more playlists: one numpy array per column instead of
+    one python object per track and column. String columns are object arrays of interned strings,
+    so an artist occurring on many tracks or playlists is kept once; duration (ms) and popularity
+    are plain integer arrays.
+    Slicing with a slice returns a TrackBatch of views on the same arrays (no copy); a single index
+    returns the track as (uri, name, artists, duration, popularity), which is also what iterating
+    over a batch yields.
+    '''
+
+    COLUMNS = ('uri', 'name', 'artists', 'duration', 'popularity')
+    STRING_COLUMNS = ('uri', 'name', 'artists')
+    DTYPES = {'duration': 'int32', 'popularity': 'int8'}
+
+    def __init__(self, uri = (), name = (), artists = (), duration = (), popularity = ()):
+        import numpy as np
+
+        columns = {'uri': uri, 'name': name, 'artists': artists, 'duration': duration, 'popularity': popularity}
+        for column, values in columns.items():
+            if column in self.STRING_COLUMNS:
+                values = self.as_string_array(values)
+            else:
+                values = np.asarray(values, dtype = self.DTYPES[column])
+            setattr(self, column, values)
+
+        lengths = {len(getattr(self, column)) for column in self.COLUMNS}
+        if len(lengths) > 1:
+            raise ValueError(f'Columns of a TrackBatch need the same length, got {sorted(lengths)}.')
+
+    @staticmethod
+    def as_string_array(values):
+        import numpy as np
+        from sys import intern
+
+        if isinstance(values, np.ndarray) and (values.dtype == object):
+            # already interned by another batch; keeps slices and views zero-copy
+            return values
+
+        array = np.empty(len(values), dtype = object)
+        array[:] = [intern(str(value)) for value in values]
+        return array
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        # tracks: iterable of (uri, name, artists, duration, popularity)
+        tracks = list(tracks)
+        if not tracks:
+            return cls()
+        return cls(*zip(*tracks))
+
+    @classmethod
+    def concat(cls, batches):
+        import numpy as np
+
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls()
+        return cls(*[np.concatenate([getattr(batch, column) for batch in batches]) for column in cls.COLUMNS])
+
+    def __len__(self):
+        return len(self.uri)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.from_columns([getattr(self, column)[key] for column in self.COLUMNS])
+        return (self.uri[key], self.name[key], self.artists[key], int(self.duration[key]), int(self.popularity[key]))
+
+    def __iter__(self):
+        # tolist() turns the numeric columns into python ints in one go
+        return zip(self.uri, self.name, self.artists, self.duration.tolist(), self.popularity.tolist())
+
+    def __repr__(self):
+        return f'TrackBatch({len(self)} tracks)'
+
+    @classmethod
+    def from_columns(cls, columns):
+        # bypasses the conversions of __init__ for arrays that come from another batch
+        batch = cls.__new__(cls)
+        for column, values in zip(cls.COLUMNS, columns):
+            setattr(batch, column, values)
+        return batch
+
+    def take(self, indices):
+        # fancy indexing copies, unlike slicing
+        import numpy as np
+
+        indices = np.asarray(indices, dtype = np.intp)
+        return self.from_columns([getattr(self, column)[indices] for column in self.COLUMNS])
+
+    def drop(self, indices):
+        import numpy as np
+
+        keep = np.ones(len(self), dtype = bool)
+        keep[np.asarray(indices, dtype = np.intp)] = False
+        return self.from_columns([getattr(self, column)[keep] for column in self.COLUMNS])
+
+    def to_pandas(self, column_names = None):
+        # column_names: optional mapping from the columns of the batch to the ones of the DataFrame
+        from pandas import DataFrame as pd_DataFrame
+
+        column_names = column_names or {}
+        return pd_DataFrame(
+                    {column_names.get(column, column): getattr(self, column) for column in self.COLUMNS},
+                    copy = False)
+
+    def to_arrow(self, column_names = None):
+        from src.utils import install_pip_pkg
+        install_pip_pkg({'pyarrow'})
+        import pyarrow as pa
+
+        column_names = column_names or {}
+        arrays = []
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            if column in self.STRING_COLUMNS:
+                arrays.append(pa.array(values, type = pa.string()))
+            else:
+                # numeric columns are handed over without a copy
+                arrays.append(pa.array(values))
+        return pa.table(arrays, names = [column_names.get(column, column) for column in self.COLUMNS])
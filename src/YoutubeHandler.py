@@ -3,15 +3,53 @@
 class YoutubeHandler():
     from src.utils import PrintLogger
     
-    def __init__(self, _async_handler, dump_info):
+    # backends that extract youtube's raw heat markers (see get_heat_markers) can serve
+    # get_most_replayed from the heatmap cache
+    provides_heat_markers = False
+    
+    def __init__(
+                    self, 
+                    _async_handler, 
+                    dump_info, 
+                    heatmap_cache = None, 
+                    search_cache_path = 'SEARCH_CACHE.sqlite',
+                    search_cache_ttl_in_sec = 30 * 24 * 60 * 60,
+                    search_cache_max_entries = 50000,
+                    search_cache_memory_size = 1024):
         self.proxy_handler = None
+        self.proxy_address = None
         self.user_agent = None
         self.ash = _async_handler        
         self.dump_info = dump_info
+        self.heatmap_cache = heatmap_cache
+        
+        # shared by all fetches of this handler; returns responses instead of storing them
+        from src.RetryHandler import RetryHandler
+        self.retry_handler = RetryHandler()
+        
+        # spotify track uri -> (yt_vid_id, yt_vid_name)
+        from src.CacheHandler import CacheHandler
+        self.search_cache = CacheHandler(
+                                search_cache_path,
+                                table = 'searches',
+                                ttl_in_sec = search_cache_ttl_in_sec,
+                                max_entries = search_cache_max_entries,
+                                memory_size = search_cache_memory_size)
+        self.search_session = None
+        self.search_client = None
             
     def __exit__(self, exc_type, exc_value, exc_traceback):
         
         with self.dump_info('Exiting YoutubeHandler'):
+            if self.heatmap_cache:
+                self.heatmap_cache.close()
+            self.search_cache.close()
+            
+            if self.search_session:
+                self.search_session.close()
+            if self.search_client and not self.search_client.closed:
+                self.ash.create_task(self.search_client.close())
+                
             del self.user_agent
             del self.ash        
             del self.proxy_handler
@@ -29,7 +67,7 @@ class YoutubeHandler():
         with self.dump_info('Starting Proxy Server'):
             from src.ProxyServer import ProxyServer
             self.proxy_handler = ProxyServer(_async_handler = self.ash)
-            await self.proxy_handler.find_proxies()
+            await self.proxy_handler.start()
              
         await self.setup_connection()
         
@@ -44,11 +82,23 @@ class YoutubeHandler():
         self.dump_info().log('Got a Proxy')
         was_success = self.set_proxy_for_running(proxy_ip, proxy_port)
         if was_success:
+            self.proxy_address = (proxy_ip, proxy_port)
             self.dump_info().log(f'Using proxy = https://{proxy_ip}:{proxy_port}.') 
         else:
             self.dump_info().log(f'Setting proxy FAILED.') 
+    
+    # feeding the health scores of the proxy pool
+    def report_proxy_success(self, latency_in_sec, proxy_address = None):
+        proxy_address = proxy_address or self.proxy_address
+        if self.proxy_handler and proxy_address:
+            self.proxy_handler.report_success(*proxy_address, latency_in_sec)
+            
+    def report_proxy_failure(self, is_captcha = False, proxy_address = None):
+        proxy_address = proxy_address or self.proxy_address
+        if self.proxy_handler and proxy_address:
+            self.proxy_handler.report_failure(*proxy_address, is_captcha = is_captcha)
       
-    def set_user_agent_for_running(self):
+    def get_random_user_agent(self):
         if not self.user_agent:
             from src.utils import install_pip_pkg
             install_pip_pkg({'fake_useragent'})
@@ -56,7 +106,10 @@ class YoutubeHandler():
             from fake_useragent import UserAgent
             self.user_agent = UserAgent()
             
-        user_agent = self.user_agent.random
+        return self.user_agent.random
+        
+    def set_user_agent_for_running(self):
+        user_agent = self.get_random_user_agent()
         was_success = self.set_user_agent_for_running(user_agent)
         
         if was_success:
@@ -64,37 +117,126 @@ class YoutubeHandler():
         else:
             self.dump_info().log(f'Setting proxy FAILED.') 
 
-    async def get(self, url, retries = 0):
+    async def get(self, url, read = None):
+        # read: optional coroutine function taking the response; reading the body then counts
+        # towards the same attempt, i.e. its errors are retried and bounded by the same deadline
+        pass
+        
+    async def get_heat_markers(self, response):
+        pass
+    
+    def build_graph_from_markers(self, heat_markers, total_duration_in_ms):
         pass
         
     async def get_most_replayed(self, vid_id, total_duration_in_ms):  
+        if self.provides_heat_markers and self.heatmap_cache:
+            heat_markers = self.heatmap_cache.get(vid_id)
+            if heat_markers is not None:
+                self.dump_info().log(f'Using cached heatmap for {vid_id}.')
+                return self.build_graph_from_markers(heat_markers, total_duration_in_ms)
+        
         video_path = f'https://www.youtube.com/watch?v={vid_id}'
         
         self.dump_info().log(f'Opening URL {video_path}')
-        await self.get(video_path)
+        if not self.provides_heat_markers:
+            response = await self.get(video_path)
+            graph = await self.get_heatmaps_from_yt(total_duration_in_ms, response)
+            return graph 
         
-        graph = await self.get_heatmaps_from_yt(total_duration_in_ms)
-        return graph 
-    
-    def search(self, query, return_amount = 3, skip_ids = []):
-        from src.utils import PrintLogger
+        # fetching and parsing are one attempt: a body that breaks off or trickles in is retried
+        heat_markers = await self.get(video_path, read = self.get_heat_markers)
+        if heat_markers is None:
+            return None
         
+        if self.heatmap_cache:
+            self.heatmap_cache.put(vid_id, heat_markers)
+        return self.build_graph_from_markers(heat_markers, total_duration_in_ms)
+    
+    def build_search_url(self, query, skip_ids = []):
         if len(skip_ids) > 0:
             self.dump_info().log(f'Searching again for {query=}.')
             
         query = query.replace(' ', '+')
-        return_amount += len(skip_ids)
         
         # order = {date, rating, relevance, title, videoCount, viewCount) see above link
-        lemnos_yt_url = f'https://yt.lemnoslife.com/search?part=id,snippet&q={query}&type=video&order=viewCount'
+        return f'https://yt.lemnoslife.com/search?part=id,snippet&q={query}&type=video&order=viewCount'
+    
+    def search(self, query, return_amount = 3, skip_ids = [], cache_key = None):
+        # cache_key i.e. the spotify track uri; only plain searches without skip_ids are cached
+        use_cache = cache_key and not skip_ids
+        if use_cache:
+            cached = self.search_cache.get(cache_key)
+            if cached:
+                return cached
+            
+        lemnos_yt_url = self.build_search_url(query, skip_ids)
 
-        import requests
-        response = requests.get(lemnos_yt_url)
+        if not self.search_session:
+            import requests
+            self.search_session = requests.Session()
+            
+        response = self.search_session.get(lemnos_yt_url, timeout = 10)
         if response.status_code != 200:
             raise Exception(f'Returned code {response.status_code} for url = {lemnos_yt_url}')
 
-        import json
-        yt_search = response.json()['items']
+        result = self.choose_search_result(query, response.json()['items'], return_amount, skip_ids)
+        if use_cache and result[0]:
+            self.search_cache.put(cache_key, result)
+        return result
+    
+    def get_search_client(self, max_concurrency = 10):
+        # one pooled client for all concurrent searches; has to be created inside the running loop
+        if (not self.search_client) or self.search_client.closed:
+            from src.utils import install_pip_pkg
+            install_pip_pkg({'aiohttp'})
+            import aiohttp
+            
+            self.search_client = aiohttp.ClientSession(
+                                    connector = aiohttp.TCPConnector(limit = max_concurrency),
+                                    timeout = aiohttp.ClientTimeout(total = 10))
+        return self.search_client
+        
+    async def search_async(self, query, return_amount = 3, skip_ids = [], cache_key = None):
+        use_cache = cache_key and not skip_ids
+        if use_cache:
+            cached = self.search_cache.get(cache_key)
+            if cached:
+                return cached
+            
+        lemnos_yt_url = self.build_search_url(query, skip_ids)
+        
+        async with self.get_search_client().get(lemnos_yt_url) as response:
+            if response.status != 200:
+                raise Exception(f'Returned code {response.status} for url = {lemnos_yt_url}')
+            yt_search = (await response.json())['items']
+            
+        result = self.choose_search_result(query, yt_search, return_amount, skip_ids)
+        if use_cache and result[0]:
+            self.search_cache.put(cache_key, result)
+        return result
+    
+    async def search_many(self, queries, cache_keys = None, max_concurrency = 10):
+        # resolves all queries concurrently over one client; results are in the order of queries
+        from asyncio import Semaphore as asyncio_Semaphore
+        
+        if not cache_keys:
+            cache_keys = [None] * len(queries)
+        
+        semaphore = asyncio_Semaphore(max_concurrency)
+        self.get_search_client(max_concurrency)
+        
+        async def bounded_search(query, cache_key):
+            async with semaphore:
+                return await self.search_async(query, cache_key = cache_key)
+            
+        return await self.ash.gather(*[bounded_search(query, cache_key) 
+                                       for query, cache_key in zip(queries, cache_keys)])
+    
+    def choose_search_result(self, query, yt_search, return_amount = 3, skip_ids = []):
+        from src.utils import PrintLogger
+        
+        query = query.replace(' ', '+')
+        return_amount += len(skip_ids)
         
         vid_ids, vid_names = [], []
         i = 0 
@@ -0,0 +1,219 @@
+#########################################################################
+##########     REGARDING POPULARITY GRAPHS ###########################
+#########################################################################
+
+# a popularity graph is what the youtube handlers return for a video: a Heatmap whose 'x' holds the
+# timestamps in ms, 'y' the popularity at that timestamp and 'is_regular' tells whether the timestamps
+# are evenly spaced (requests based heatmaps) or not (selenium based heatmaps)
+
+class Heatmap():
+    '''
+    Popularity graph of one video. x and y are float32 arrays; they may be views into a larger
+    buffer, i.e. a memory-mapped SongCatalogue.
+    '''
+    __slots__ = ('x', 'y', 'is_regular')
+
+    def __init__(self, x, y, is_regular):
+        import numpy as np
+
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.is_regular = bool(is_regular)
+
+    def __len__(self):
+        return len(self.y)
+
+    def __repr__(self):
+        return f'Heatmap({len(self)} points, is_regular={self.is_regular})'
+
+def build_heatmap_from_markers(heat_markers, total_duration_in_ms = None):
+    '''
+    Builds the Heatmap from youtube's heat markers (start, duration and score per marker, see
+    HeatMarkerScanner). The marker times are rescaled to total_duration_in_ms, i.e. the duration of
+    the spotify track; without it they stay in video time.
+    '''
+    from numpy import std as np_std
+
+    (time_start_in_ms, duration_in_ms, score) = heat_markers
+    max_time = time_start_in_ms[-1] + duration_in_ms[-1]
+    if not total_duration_in_ms:
+        total_duration_in_ms = max_time
+
+    return Heatmap(
+                time_start_in_ms / max_time * total_duration_in_ms,
+                score,
+                np_std(duration_in_ms) == 0)
+
+def build_heatmap_from_paths(chapter_times, heatmaps, total_duration_in_ms):
+    '''
+    Builds the Heatmap from what selenium scrapes of the progress bar: the style of every chapter
+    ('width: <px>px; left: <px>px;') and the svg path of its heatmap. The points of all chapters are
+    parsed into one pair of preallocated arrays, then shifted, scaled and rescaled to
+    total_duration_in_ms with vector ops.
+    '''
+    import numpy as np
+    from re import compile as re_compile
+
+    # px factors inside of youtube's progress bar, not actual times
+    chapter_pattern = re_compile(r'width: (\d+)px; left: (\d+)px;')
+    # x,y pairs; the first pair is always 0.0,100.0
+    coord_pattern = re_compile(r'\s([\d.]+),([\d.]+)\s')
+
+    chapters = []
+    for time, path in zip(chapter_times, heatmaps):
+        duration_factor, offset_factor = chapter_pattern.match(time).group(1, 2)
+        coords = np.array(coord_pattern.findall(path)[1:], dtype=np.float64).reshape(-1, 2)
+        chapters.append((float(duration_factor), float(offset_factor), coords))
+
+    n_points = sum(len(coords) for _, _, coords in chapters)
+    x = np.empty(n_points, dtype=np.float64)
+    y = np.empty(n_points, dtype=np.float64)
+    start = 0
+    for duration_factor, offset_factor, coords in chapters:
+        end = start + len(coords)
+        np.multiply(coords[:, 0], duration_factor / 1000.0, out=x[start:end])
+        x[start:end] += offset_factor
+        np.subtract(100.0, coords[:, 1], out=y[start:end])
+        start = end
+
+    assert x[-1] == x.max()
+    x *= total_duration_in_ms / x[-1]
+    return Heatmap(x, y, is_regular=False)
+
+def find_best_window(x, y, window_ms, is_regular):
+    '''
+    Returns the start in ms of the window of length window_ms with the highest summed popularity.
+
+    x and y are either one graph (1-D) or a batch of graphs with the same number of points (2-D,
+    one graph per row); for a batch an array with one start per graph is returned.
+    A window ending at x[i] covers all points in (x[i] - window_ms, x[i]]. For irregular graphs
+    every point is weighted by the time until the next point.
+    '''
+    from numpy import ndim as np_ndim
+
+    snippet_start = find_best_windows(x, y, [window_ms], is_regular)[..., 0]
+    if np_ndim(x) == 2:
+        return snippet_start
+    return int(snippet_start)
+
+def get_window_sums(x, y, windows_ms, is_regular):
+    '''
+    Summed popularity of the window ending at every point, for every length in windows_ms.
+    Returns x as a 2-D float64 array (one row per graph) and the sums with the axes graph, window,
+    point. The prefix sums are built once and all windows are scored in one vectorized pass.
+    '''
+    import numpy as np
+
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    windows_ms = np.asarray(windows_ms, dtype=np.float64).reshape(1, -1, 1)
+    n_graphs, n_points = x.shape
+    n_windows = windows_ms.shape[1]
+    # axes of all intermediate arrays: graph, window, point
+    rows = np.arange(n_graphs)[:, None, None]
+    idx = np.arange(n_points)[None, None, :]
+
+    if is_regular:
+        weights = y
+    else:
+        # linear weighting with the time to the next timestamp; the last point gets no weight
+        weights = y * np.diff(x, axis=1, append=x[:, -1:])
+
+    # prefix sums with a leading 0 so that the sum over [lo, i] is cumsum[i+1] - cumsum[lo]
+    cumsum = np.zeros((n_graphs, n_points + 1))
+    np.cumsum(weights, axis=1, out=cumsum[:, 1:])
+
+    if is_regular:
+        # evenly spaced points: every window covers the same number of points per graph, which
+        # turns the rolling sum into a convolution with a box of that width
+        width = np.count_nonzero(x[:, None, :] > (x[:, None, -1:] - windows_ms), axis=2)[..., None]
+        lo = np.maximum(idx - width + 1, 0)
+    else:
+        # one searchsorted over all graphs and windows at once: shifting every row by more than its
+        # own span keeps the flattened timestamps sorted and the rows apart
+        span = (x.max() - x.min()) + windows_ms.max() + 1
+        offsets = rows[:, :, 0] * span
+        lo = np.searchsorted(
+                    (x + offsets).ravel(),
+                    (x[:, None, :] - windows_ms + offsets[:, :, None]).ravel(),
+                    side='right')
+        lo = lo.reshape(n_graphs, n_windows, n_points) - rows * n_points
+
+    return x, cumsum[:, None, 1:] - cumsum[rows, lo]
+
+def find_first_max(window_sums):
+    # index of the first window reaching the maximum along the last axis; the tolerance keeps
+    # rounding noise of the prefix sums from deciding between equally popular windows
+    import numpy as np
+
+    max_sums = window_sums.max(axis=-1, keepdims=True)
+    tolerance = 1e-9 * np.maximum(np.abs(max_sums), 1)
+    return np.argmax(window_sums >= max_sums - tolerance, axis=-1)
+
+def to_snippet_start(window_end, window_ms):
+    # x marks the end of a window; start is floored to full seconds and capped at 0
+    import numpy as np
+
+    snippet_start = np.maximum(window_end - window_ms, 0)
+    return (snippet_start // 1000).astype(np.int64) * 1000
+
+def find_best_windows(x, y, windows_ms, is_regular):
+    '''
+    find_best_window for several window lengths at once.
+    Returns an array with one start per window for a single graph (1-D x and y) or one row of starts
+    per graph for a batch (2-D x and y).
+    '''
+    import numpy as np
+
+    is_batch = np.ndim(x) == 2
+    x, window_sums = get_window_sums(x, y, windows_ms, is_regular)
+    best = find_first_max(window_sums)
+
+    rows = np.arange(len(x))[:, None]
+    snippet_start = to_snippet_start(x[rows, best], np.asarray(windows_ms, dtype=np.float64))
+
+    if is_batch:
+        return snippet_start
+    return snippet_start[0]
+
+def find_top_windows(x, y, window_ms, k, is_regular):
+    '''
+    Starts in ms of the up to k most popular windows of length window_ms of one graph that do not
+    overlap, best first; the first one is the start find_best_window returns.
+    Greedy suppression: after taking the best remaining window, every window overlapping it is
+    dropped. Each of the k rounds is one vectorized pass over the window sums, i.e. O(n * k).
+    '''
+    import numpy as np
+
+    x, window_sums = get_window_sums(x, y, [window_ms], is_regular)
+    snippet_starts = to_snippet_start(x[0], window_ms)
+    window_sums = window_sums[0, 0].copy()
+
+    top_starts = []
+    while (len(top_starts) < k) and np.isfinite(window_sums).any():
+        best = find_first_max(window_sums)
+        top_starts.append(int(snippet_starts[best]))
+        window_sums[np.abs(snippet_starts - snippet_starts[best]) < window_ms] = -np.inf
+    return top_starts
+
+def find_best_windows_for_graphs(graphs, windows_ms):
+    '''
+    Scores a list of popularity graphs (i.e. a whole playlist) for every length in windows_ms with
+    as few calls to find_best_windows as possible by stacking graphs of the same kind and length.
+    Returns one list of snippet starts in ms per graph, in the order of graphs.
+    '''
+    import numpy as np
+
+    groups = {}
+    for i, graph in enumerate(graphs):
+        groups.setdefault((graph.is_regular, len(graph.x)), []).append(i)
+
+    snippet_starts = [None] * len(graphs)
+    for (is_regular, _), members in groups.items():
+        x = np.array([graphs[i].x for i in members], dtype=np.float64)
+        y = np.array([graphs[i].y for i in members], dtype=np.float64)
+
+        for i, starts in zip(members, find_best_windows(x, y, windows_ms, is_regular).tolist()):
+            snippet_starts[i] = starts
+
+    return snippet_starts
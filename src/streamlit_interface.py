@@ -13,6 +13,12 @@ def RequestsYTHandler(*args, **kwargs):
     
     return RequestsYTHandler(*args, **kwargs)   
 
+@st_singleton
+def AsyncYTHandler(*args, **kwargs):
+    from src.AsyncYTHandler import AsyncYTHandler
+    
+    return AsyncYTHandler(*args, **kwargs)   
+
 @st_singleton
 def SeleniumYTHandler(*args, **kwargs):
     from src.SeleniumYTHandler import SeleniumYTHandler
@@ -25,6 +31,12 @@ def YoutubeHandler(*args, **kwargs):
     
     return YoutubeHandler(*args, **kwargs)   
 
+@st_singleton
+def SnippetCatalogue(*args, **kwargs):
+    from src.SnippetCatalogue import SnippetCatalogue
+    
+    return SnippetCatalogue(*args, **kwargs)
+
 @st_singleton
 def MedleyGenerator(*args, **kwargs):
     from src.MedleyGenerator import MedleyGenerator
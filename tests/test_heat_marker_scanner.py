@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.RequestsYTHandler import HeatMarkerScanner
+
+def make_marker(i, score):
+    return ('{"heatMarkerRenderer":{"timeRangeStartMillis":%d,"markerDurationMillis":2000,'
+            '"heatMarkerIntensityScoreNormalized":%s}}' % (i * 2000, score))
+
+def scan(page, chunk_size):
+    scanner = HeatMarkerScanner()
+    for i in range(0, len(page), chunk_size):
+        if scanner.feed(page[i:i + chunk_size]):
+            break
+    return scanner.get_heat_markers()
+
+def test_integer_scores_and_odd_markers_do_not_end_the_list():
+    markers = [make_marker(i, '1' if i == 50 else '0.5') for i in range(100)]
+    # a marker with unexpected fields is skipped, not taken as the end of the list
+    markers[60] = '{"heatMarkerRenderer":{"timeRangeStartMillis":120000}}'
+    page = ('"markers":[' + ','.join(markers) + '],"rest":1').encode()
+
+    for chunk_size in (7, 100, len(page)):
+        time_start_in_ms, duration_in_ms, score = scan(page, chunk_size)
+        assert len(score) == 99
+        assert score[50] == 1.0
+        assert time_start_in_ms[-1] == 99 * 2000
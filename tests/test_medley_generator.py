@@ -0,0 +1,113 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.MedleyGenerator import MedleyGenerator
+from src.AsyncHandler import AsyncHandler
+from src.SnippetCatalogue import SnippetCatalogue
+from src.TrackBatch import TrackBatch
+from src.popularity import Heatmap
+from src.utils import PrintLogger
+
+N_TRACKS = 10
+
+def make_graph():
+    return Heatmap([i * 2000.0 for i in range(100)], [float((i * 3) % 11) for i in range(100)], True)
+
+class FakeSpotifyHandler():
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    async def iter_playlist_pages(self, pl_uri, page_size = 100, max_tracks = None):
+        # the first page arrives after the workers are already waiting for tracks
+        await asyncio.sleep(0.05)
+        yield 0, self.tracks
+
+class FakeYTHandler():
+    async def search_async(self, query, cache_key = None):
+        return 'id' + query, 'name' + query
+
+    async def get_most_replayed(self, yt_vid_id, total_duration_in_ms):
+        await asyncio.sleep(0.01)
+        return make_graph()
+
+def make_medley_generator(tmp_path, hits):
+    from src.MedleyGenerator import Song
+
+    tracks = TrackBatch.from_tracks([(f'u{i}', f'n{i}', 'a', 200000, 50) for i in range(N_TRACKS)])
+    catalogue = SnippetCatalogue(str(tmp_path / 'catalogue.sqlite'))
+    catalogue.put_many([Song(uri, name, artists, duration, popularity, 'id' + name, 'name' + name, make_graph(), 0)
+                        for uri, name, artists, duration, popularity in tracks if uri in hits])
+
+    mg = object.__new__(MedleyGenerator)
+    mg.dump_info = PrintLogger.register('TestMedleyGenerator')
+    mg.ash = AsyncHandler()
+    mg.ash.add_queue = lambda name: mg.ash.queues.setdefault(name, asyncio.Queue())
+    mg.sp_handler = FakeSpotifyHandler(tracks)
+    mg.yt_handler = FakeYTHandler()
+    mg.catalogue = catalogue
+    mg.indexer = None
+    return mg
+
+async def play_all(mg):
+    played = []
+    async with mg.create_medley('pl', 15, look_ahead = 3) as (status, generator):
+        async for uri, snippet_start_in_ms in generator():
+            played.append(uri)
+    return played
+
+def test_look_ahead_medley_plays_catalogue_hits(tmp_path):
+    for hits in (set(), {'u0'}, {'u0', 'u1', 'u2'}):
+        (tmp_path / str(len(hits))).mkdir()
+        mg = make_medley_generator(tmp_path / str(len(hits)), hits)
+        played = asyncio.run(asyncio.wait_for(play_all(mg), timeout = 5))
+        assert played == [f'u{i}' for i in range(N_TRACKS)]
+
+class FlakyYTHandler(FakeYTHandler):
+    # youtube fails for the first fetches, opening the circuit, and works once it is half-open
+    def __init__(self, failures):
+        from src.RetryHandler import RetryHandler
+
+        self.failures = failures
+        self.retry_handler = RetryHandler(
+                                max_retries = 0,
+                                base_delay_in_sec = 0.01,
+                                failure_threshold = 2,
+                                reset_timeout_in_sec = 0.2)
+
+    async def get_most_replayed(self, yt_vid_id, total_duration_in_ms):
+        from src.RetryHandler import RetryableError
+
+        async def attempt():
+            if self.failures > 0:
+                self.failures -= 1
+                raise RetryableError('Proxy failed.')
+            return make_graph()
+
+        return await self.retry_handler.run(attempt, yt_vid_id)
+
+def test_open_circuit_postpones_tracks_instead_of_dropping_them(tmp_path):
+    mg = make_medley_generator(tmp_path, set())
+    mg.yt_handler = FlakyYTHandler(failures = 4)
+
+    played = asyncio.run(asyncio.wait_for(play_all(mg), timeout = 5))
+    # the tracks that failed themselves are skipped; the others wait for the circuit to close
+    assert len(played) == N_TRACKS - 4
+
+def test_resolved_songs_are_catalogued_with_their_snippet_starts(tmp_path):
+    mg = make_medley_generator(tmp_path, hits = set())
+    rescored = []
+    get_snippet_starts = mg.catalogue.get_snippet_starts
+    def count_rescoring(graphs):
+        rescored.extend(graphs)
+        return get_snippet_starts(graphs)
+    mg.catalogue.get_snippet_starts = count_rescoring
+
+    asyncio.run(play_all(mg))
+
+    assert len(mg.catalogue) == N_TRACKS
+    assert not rescored
+    song = mg.catalogue.get(('u0', 'n0', 'a', 200000, 50), 15)
+    assert song.snippet_starts == mg.sliding_windows(make_graph(), mg.catalogue.window_sizes_in_sec)
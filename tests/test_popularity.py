@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from src.popularity import Heatmap, find_best_window, find_best_windows, find_best_windows_for_graphs
+
+WINDOWS_IN_SEC = (5, 10, 15, 30)
+
+def rolling_window(x, y, window_ms, is_regular):
+    # the rolling window the scorer replaced (pandas rolling over a datetime index), point by point:
+    # the window ending at x[i] sums (x[i] - window_ms, x[i]], the first maximum wins
+    x = [float(value) for value in x]
+    y = [float(value) for value in y]
+    if is_regular:
+        weights = y
+    else:
+        weights = [y[i] * (x[i + 1] - x[i] if i + 1 < len(x) else 0.0) for i in range(len(x))]
+
+    best_sum, best_end = None, None
+    for end in x:
+        window_sum = sum(weight for time, weight in zip(x, weights) if end - window_ms < time <= end)
+        if (best_sum is None) or (window_sum > best_sum):
+            best_sum, best_end = window_sum, end
+    return int(max(best_end - window_ms, 0) // 1000) * 1000
+
+def make_graphs(seed, n_graphs):
+    rng = np.random.default_rng(seed)
+    graphs = []
+    for i in range(n_graphs):
+        n_points = int(rng.integers(10, 120))
+        # integer scores make equally popular windows exact ties
+        y = rng.integers(0, 100, n_points) if i % 3 == 0 else rng.random(n_points)
+        if i % 2:
+            # evenly spaced, so window bounds fall exactly on points
+            step = float(rng.choice([500, 1000, 2000, 2500, 3000]))
+            graphs.append(Heatmap(np.arange(1, n_points + 1) * step, y, True))
+        elif i % 4 == 0:
+            # irregular on a whole-second grid, also hitting the window bounds exactly
+            graphs.append(Heatmap(np.cumsum(rng.integers(1, 5, n_points) * 1000), y, False))
+        else:
+            graphs.append(Heatmap(np.cumsum(rng.integers(100, 4000, n_points)), y, False))
+    return graphs
+
+def test_best_window_matches_the_rolling_window():
+    for graph in make_graphs(seed = 0, n_graphs = 200):
+        for window_in_sec in WINDOWS_IN_SEC:
+            expected = rolling_window(graph.x, graph.y, window_in_sec * 1000, graph.is_regular)
+            assert find_best_window(graph.x, graph.y, window_in_sec * 1000, graph.is_regular) == expected
+
+def test_best_window_picks_the_first_of_equal_windows():
+    x = np.arange(1, 61) * 1000
+    y = np.zeros(60)
+    y[[9, 39]] = 1
+
+    for is_regular in (True, False):
+        assert find_best_window(x, y, 10000, is_regular) == rolling_window(x, y, 10000, is_regular) == 0
+
+def test_windows_of_all_sizes_and_graphs_match_one_by_one():
+    graphs = make_graphs(seed = 1, n_graphs = 60)
+    windows_ms = [size * 1000 for size in WINDOWS_IN_SEC]
+
+    snippet_starts = find_best_windows_for_graphs(graphs, windows_ms)
+
+    for graph, starts in zip(graphs, snippet_starts):
+        assert starts == find_best_windows(graph.x, graph.y, windows_ms, graph.is_regular).tolist()
+        assert starts == [rolling_window(graph.x, graph.y, window_ms, graph.is_regular) for window_ms in windows_ms]
@@ -0,0 +1,25 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.SnippetBatch import SnippetBatch
+from src.RetryHandler import CircuitOpenError
+
+def test_jobs_hitting_an_open_circuit_are_repeated():
+    calls = {}
+
+    async def job(i):
+        calls[i] = calls.get(i, 0) + 1
+        if i == 3:
+            raise ValueError('No heatmap.')
+        if calls[i] == 1:
+            raise CircuitOpenError('Circuit open.', 0.01)
+        return str(i)
+
+    with SnippetBatch(no_of_processes = 1, max_concurrency = 2) as batch:
+        results = asyncio.run(batch.run_bounded(job, [(i,) for i in range(6)]))
+
+    assert results == ['0', '1', '2', '4', '5']
+    assert calls == {0: 2, 1: 2, 2: 2, 3: 1, 4: 2, 5: 2}
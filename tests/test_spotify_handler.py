@@ -0,0 +1,111 @@
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.SpotifyHandler import SpotifyHandler
+from src.AsyncHandler import AsyncHandler
+from src.CacheHandler import CacheHandler
+
+def make_sp_handler(bulk_cache_size):
+    # a handler without a spotify connection; responses echo the requested ids
+    sp_handler = object.__new__(SpotifyHandler)
+    sp_handler.ash = AsyncHandler()
+    sp_handler.executor = ThreadPoolExecutor(max_workers = 4)
+    sp_handler.bulk_cache = CacheHandler(None, memory_size = bulk_cache_size)
+    sp_handler.bulk_pending = {}
+    sp_handler.requested = []
+
+    def retrieve(func, ids, **kwargs):
+        sp_handler.requested += ids
+        return {'tracks': [{'id': id} for id in ids]}
+
+    async def retrieve_async(func, ids, **kwargs):
+        return retrieve(func, ids, **kwargs)
+
+    sp_handler.retrieve = retrieve
+    sp_handler.retrieve_async = retrieve_async
+    return sp_handler
+
+def test_bulk_results_do_not_depend_on_the_cache_size():
+    ids = [f'id{i}' for i in range(250)]
+
+    sp_handler = make_sp_handler(bulk_cache_size = 100)
+    assert sp_handler.retrieve_bulk('tracks', ids) == [{'id': id} for id in ids]
+
+    sp_handler = make_sp_handler(bulk_cache_size = 100)
+    assert asyncio.run(sp_handler.retrieve_bulk_async('tracks', ids + ids[:10])) == [{'id': id} for id in ids + ids[:10]]
+    assert len(sp_handler.requested) == len(ids)
+
+def test_bulk_skips_cached_ids():
+    sp_handler = make_sp_handler(bulk_cache_size = 1000)
+    sp_handler.retrieve_bulk('tracks', ['a', 'b'])
+    assert sp_handler.retrieve_bulk('tracks', ['b', 'c', 'a']) == [{'id': 'b'}, {'id': 'c'}, {'id': 'a'}]
+    assert sp_handler.requested == ['a', 'b', 'c']
+
+def test_cancelled_bulk_fetch_leaves_nothing_pending():
+    sp_handler = make_sp_handler(bulk_cache_size = 1000)
+    fetch_again = asyncio.Event()
+
+    async def retrieve_async(func, ids, **kwargs):
+        if not fetch_again.is_set():
+            await asyncio.sleep(10)
+        return {'tracks': [{'id': id} for id in ids]}
+    sp_handler.retrieve_async = retrieve_async
+
+    async def main():
+        task = asyncio.create_task(sp_handler.retrieve_bulk_async('tracks', ['a', 'b']))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
+        assert not sp_handler.bulk_pending
+
+        fetch_again.set()
+        return await asyncio.wait_for(sp_handler.retrieve_bulk_async('tracks', ['a']), timeout = 1)
+
+    assert asyncio.run(main()) == [{'id': 'a'}]
+
+def test_sync_bulk_fetches_ids_pending_in_an_async_call():
+    sp_handler = make_sp_handler(bulk_cache_size = 1000)
+
+    async def main():
+        started = asyncio.Event()
+
+        async def retrieve_async(func, ids, **kwargs):
+            started.set()
+            await asyncio.sleep(0.1)
+            return {'tracks': [{'id': id} for id in ids]}
+        sp_handler.retrieve_async = retrieve_async
+
+        task = asyncio.create_task(sp_handler.retrieve_bulk_async('tracks', ['a', 'b']))
+        await started.wait()
+        assert sp_handler.retrieve_bulk('tracks', ['a', 'c']) == [{'id': 'a'}, {'id': 'c'}]
+        return await task
+
+    assert asyncio.run(main()) == [{'id': 'a'}, {'id': 'b'}]
+
+def test_sync_bulk_chunks_are_spaced():
+    from time import monotonic
+    from src.RetryHandler import RateLimiter
+
+    sp_handler = make_sp_handler(bulk_cache_size = 1000)
+    del sp_handler.retrieve
+    sp_handler.response_caches = {}
+    sp_handler.methods = {}
+    sp_handler.max_rate_limit_retries = 0
+    sp_handler.rate_limiter = RateLimiter(0.05)
+    sent = []
+
+    def tracks(ids, **kwargs):
+        sent.append(monotonic())
+        return {'tracks': [{'id': id} for id in ids]}
+    sp_handler.methods['tracks'] = tracks
+
+    ids = [f'id{i}' for i in range(200)]
+    assert sp_handler.retrieve_bulk('tracks', ids) == [{'id': id} for id in ids]
+
+    sent.sort()
+    assert len(sent) == 4
+    assert all(later - earlier >= 0.045 for earlier, later in zip(sent, sent[1:]))
@@ -0,0 +1,82 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from requests.exceptions import ChunkedEncodingError
+
+from src.RequestsYTHandler import RequestsYTHandler, FetchShard
+from src.RetryHandler import RetryHandler
+from src.utils import PrintLogger
+
+PAGE = ('"markers":[' + ','.join(
+            '{"heatMarkerRenderer":{"timeRangeStartMillis":%d,"markerDurationMillis":2000,'
+            '"heatMarkerIntensityScoreNormalized":0.5}}' % (i * 2000) for i in range(100)) + ']').encode()
+
+class FakeResponse():
+    def __init__(self, url, breaks_off):
+        self.url = url
+        self.breaks_off = breaks_off
+
+    def iter_content(self, chunk_size):
+        yield PAGE[:100]
+        if self.breaks_off:
+            raise ChunkedEncodingError('Connection broken.')
+        yield PAGE[100:]
+
+    def close(self):
+        pass
+
+class FakeSession():
+    def __init__(self, broken_bodies):
+        self.broken_bodies = broken_bodies
+
+    def get(self, url, **kwargs):
+        self.broken_bodies -= 1
+        return FakeResponse(url, breaks_off = self.broken_bodies >= 0)
+
+    def close(self):
+        pass
+
+def make_yt_handler(broken_bodies):
+    yt_handler = object.__new__(RequestsYTHandler)
+    yt_handler.dump_info = PrintLogger.register('TestYTHandler')
+    yt_handler.proxy_handler = None
+    yt_handler.proxy_address = None
+    yt_handler.heatmap_cache = None
+    yt_handler.retry_handler = RetryHandler(base_delay_in_sec = 0.01)
+    yt_handler.failures = []
+    yt_handler.report_proxy_failure = lambda **kwargs: yt_handler.failures.append(kwargs)
+
+    shard = FetchShard(0)
+    shard.session = FakeSession(broken_bodies)
+    yt_handler.shards = [shard]
+    return yt_handler
+
+def test_broken_bodies_are_retried_and_reported():
+    yt_handler = make_yt_handler(broken_bodies = 2)
+
+    graph = asyncio.run(yt_handler.get_most_replayed('vid', 200000))
+
+    assert len(graph) == 100
+    assert len(yt_handler.failures) == 2
+
+def test_shard_is_released_when_cancelled_while_waiting():
+    yt_handler = make_yt_handler(broken_bodies = 0)
+    shard = yt_handler.shards[0]
+    shard.rate_limiter.min_interval_in_sec = 60
+
+    async def cancel_second_request():
+        await yt_handler.get('https://www.youtube.com/watch?v=vid')
+        waiting = asyncio.create_task(yt_handler.get('https://www.youtube.com/watch?v=vid'))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_second_request())
+
+    assert shard.in_flight == 0